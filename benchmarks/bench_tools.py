@@ -0,0 +1,77 @@
+"""Benchmarks the per-request cost of turning on a MultiHookPointTool.
+
+usage: python benchmarks/bench_tools.py [NUMBER]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+import cherrypy
+from cherrypy._cprequest import HookMap, Request, hookpoints
+from cherrypy.lib.httputil import Host
+
+from blueberrypy.tools import MultiHookPointTool
+
+
+class BenchTool(MultiHookPointTool):
+
+    def on_start_resource(self, bindings=None, profile=False):
+        pass
+
+    def before_finalize(self):
+        pass
+
+    def after_error_response(self):
+        pass
+
+
+class LegacyBenchTool(BenchTool):
+    """Reimplements the hook wiring as it was before hook plans were cached."""
+
+    def _setup(self):
+        request = cherrypy.serving.request
+        conf = self._merged_args()
+        for hook_point in hookpoints:
+            if hasattr(self, hook_point):
+                hook = getattr(self, hook_point)
+                if not callable(hook):
+                    pass
+                hook_conf = {}
+                for k, v in conf.viewitems():
+                    if k.startswith(hook_point):
+                        k = k.replace(hook_point, "").split(".", 1)[-1]
+                        hook_conf[k] = v
+                priority = hook_conf.pop("priority", self._priority)
+                request.hooks.attach(hook_point, hook, True, priority, **hook_conf)
+
+
+TOOL_CONFIG = {"on_start_resource.bindings": ["User", "Address"],
+               "on_start_resource.profile": True,
+               "before_finalize.priority": 60}
+
+
+def bench(tool, number):
+    request = Request(Host("127.0.0.1", 80), Host("127.0.0.1", 1111))
+    cherrypy.serving.request = request
+
+    def setup_request():
+        # CherryPy builds new hooks and toolmaps on every request
+        request.hooks = HookMap(hookpoints)
+        request.toolmaps = {"tools": {tool._name: dict(TOOL_CONFIG)}}
+        tool._setup()
+
+    return min(timeit.repeat(setup_request, number=number, repeat=5)) / number
+
+
+def main(number=20000):
+    legacy = bench(LegacyBenchTool(name="bench"), number)
+    current = bench(BenchTool(name="bench"), number)
+    print("legacy _setup:  %.2f usec" % (legacy * 1e6))
+    print("current _setup: %.2f usec" % (current * 1e6))
+    print("speedup:        %.2fx" % (legacy / current))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,155 @@
+"""Benchmarks serializing large lists of SQLAlchemy model objects.
+
+Prints the best time of each scenario, and how much the peak memory use grew
+while running it once in a forked process.
+
+usage: python benchmarks/bench_util.py [ROWS]
+"""
+
+from __future__ import print_function
+
+import os
+import resource
+import sys
+import timeit
+
+from datetime import date, datetime
+
+from sqlalchemy import (Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, Unicode,
+                        create_engine)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import backref, relationship, sessionmaker
+
+from blueberrypy.util import json, to_collection, to_columns
+
+
+Base = declarative_base()
+
+
+class Author(Base):
+    __tablename__ = "author"
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(128))
+
+
+class Book(Base):
+    __tablename__ = "book"
+    id = Column(Integer, primary_key=True)
+    title = Column(Unicode(128))
+    published = Column(Date)
+    pages = Column(Integer)
+    author_id = Column(Integer, ForeignKey(Author.id))
+    author = relationship(Author, backref=backref("books"))
+
+
+class Measurement(Base):
+    __tablename__ = "measurement"
+    id = Column(Integer, primary_key=True)
+    recorded = Column(DateTime)
+    station = Column(Unicode(32))
+    valid = Column(Boolean)
+
+
+# wide rows of mostly JSON native values
+for i in range(24):
+    setattr(Measurement, "value%d" % i, Column(Float))
+    setattr(Measurement, "count%d" % i, Column(Integer))
+
+
+def make_books(rows):
+    authors = [Author(id=i, name=u"Author %d" % i) for i in range(rows // 10 + 1)]
+    return [Book(id=i, title=u"Book %d" % i, published=date(2000, 1, 1), pages=i,
+                 author=authors[i // 10])
+            for i in range(rows)]
+
+
+def make_measurements(rows):
+    columns = dict([("value%d" % i, i * 0.5) for i in range(24)])
+    columns.update([("count%d" % i, i) for i in range(24)])
+    return [Measurement(id=i, recorded=datetime(2000, 1, 1), station=u"Station %d" % (i % 10),
+                        valid=True, **columns)
+            for i in range(rows)]
+
+
+def make_session(books):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(books)
+    session.commit()
+    session.close()
+    return session
+
+
+def scenarios(books, measurements):
+    return [("to_collection per row", lambda: [to_collection(book) for book in books]),
+            ("to_collection per row, excludes",
+             lambda: [to_collection(book, excludes=["pages"]) for book in books]),
+            ("to_collection list, recursive",
+             lambda: to_collection(books, recursive=True, excludes={Author: set(["books"])})),
+            ("to_collection list, recursive, dumps",
+             lambda: json.dumps(to_collection(books, recursive=True,
+                                              excludes={Author: set(["books"])}))),
+            ("to_collection list, recursive, json",
+             lambda: to_collection(books, recursive=True, excludes={Author: set(["books"])},
+                                   format="json")),
+            ("to_collection per row, wide",
+             lambda: [to_collection(measurement) for measurement in measurements]),
+            ("to_columns, wide", lambda: to_columns(measurements)),
+            ("to_collection per row, wide, json",
+             lambda: to_collection([to_collection(measurement) for measurement in measurements],
+                                   format="json")),
+            ("to_columns, wide, json", lambda: to_columns(measurements, format="json"))]
+
+
+def query_scenarios(session):
+    columns = [getattr(Book, attr) for attr in ("author_id", "id", "pages", "published", "title")]
+    return [("query models, to_collection",
+             lambda: ([to_collection(book) for book in session.query(Book)],
+                      session.expunge_all())),
+            ("query authors, to_collection recursive",
+             lambda: (to_collection(session.query(Author).all(), recursive=True),
+                      session.expunge_all())),
+            ("query columns, to_collection",
+             lambda: to_collection(session.query(*columns).all(), recursive=True)),
+            ("select rows, to_collection",
+             lambda: to_collection(session.execute(Book.__table__.select()).fetchall(),
+                                   recursive=True))]
+
+
+def peak_memory(func):
+    """Returns by how many kilobytes running `func` grows the peak memory use."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(after - before).encode())
+        os._exit(0)
+
+    os.close(write_fd)
+    grown = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(grown)
+
+
+def main(rows=10000):
+    books = make_books(rows)
+    measurements = make_measurements(rows)
+    # measure memory before anything else, as memory freed by running a
+    # scenario or setting up the database is reused instead of growing the
+    # peak memory use
+    results = [(name, func, peak_memory(func)) for name, func in scenarios(books, measurements)]
+    session = make_session(make_books(rows))
+    results += [(name, func, peak_memory(func)) for name, func in query_scenarios(session)]
+    for name, func, grown in results:
+        elapsed = min(timeit.repeat(func, number=1, repeat=5))
+        print("%-36s %8.2f ms  %6.2f usec/row  %+8.1f MB"
+              % (name, elapsed * 1e3, elapsed / rows * 1e6, grown / 1024.0))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
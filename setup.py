@@ -67,7 +67,7 @@ setup(name="blueberrypy",
       zip_safe=False,
       install_requires=install_requires,
       extras_require={"speedups": speedup_requires,
-                      "all": ["SQLAlchemy>=0.9",
+                      "all": ["SQLAlchemy>=0.9.7",
                               "redis>=2.9",
                               "webassets>=0.9",
                               "Routes>=2.0",
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+import cherrypy
+
+from blueberrypy.exc import CircuitOpenError
+
+
+__all__ = ["CircuitBreaker"]
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """A circuit breaker guarding calls to a downstream dependency.
+
+    The breaker starts closed and lets every call through. After
+    `failure_threshold` consecutive failures, it opens and fails every call
+    fast with a `CircuitOpenError` for `cooldown` seconds. A call taking longer
+    than `slow_call_threshold` seconds, if given, counts as a failure, so a
+    dependency that slows down trips the breaker as well as one that errors.
+    Once the cooldown is over, the breaker becomes half-open and lets one probe
+    call through. If the probe succeeds the breaker closes, otherwise it opens
+    for another cooldown.
+
+    Calls can be guarded with `call()` or the breaker as a context manager::
+
+        breaker = CircuitBreaker.get("search", failure_threshold=3)
+        with breaker:
+            results = search_client.query(terms)
+
+    Callers that cannot wrap the calls themselves can use `before_call()`,
+    `record_success()` and `record_failure()` instead.
+
+    State changes are published on the `circuit_breaker` channel of `bus`,
+    which defaults to the CherryPy engine, with the breaker's name, the old
+    state and the new state as arguments.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, name, failure_threshold=5, cooldown=30, slow_call_threshold=None,
+                 exceptions=(Exception,), bus=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_call_threshold = slow_call_threshold
+        self.exceptions = exceptions
+        self.bus = bus
+        self.failures = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        self._probing_since = None
+        self._calls = threading.local()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def get(cls, name, **kwargs):
+        """Returns the breaker registered under `name`, creating and registering
+        it with `kwargs` if there isn't one yet.
+        """
+        breaker = cls.registry.get(name)
+        if breaker is None:
+            with cls._registry_lock:
+                breaker = cls.registry.get(name)
+                if breaker is None:
+                    breaker = cls.registry[name] = cls(name, **kwargs)
+        return breaker
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update()
+            return self._state
+
+    def before_call(self):
+        """Raises a `CircuitOpenError` if the call about to be made should fail
+        fast.
+        """
+        with self._lock:
+            now = time.time()
+            self._update(now)
+
+            if self._state == self.OPEN:
+                raise CircuitOpenError(self.name, self.opened_at + self.cooldown - now)
+
+            if self._state == self.HALF_OPEN:
+                # let a single probe through, or another one if it never finished
+                if self._probing_since is not None and now - self._probing_since < self.cooldown:
+                    raise CircuitOpenError(self.name, self._probing_since + self.cooldown - now)
+                self._probing_since = now
+
+    def record_success(self, elapsed=None):
+        if self.slow_call_threshold is not None and elapsed is not None:
+            if elapsed > self.slow_call_threshold:
+                self.record_failure()
+                return
+
+        with self._lock:
+            self.failures = 0
+            self._probing_since = None
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing_since = None
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                if self._state != self.OPEN:
+                    self._set_state(self.OPEN)
+
+    def call(self, func, *args, **kwargs):
+        with self:
+            return func(*args, **kwargs)
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing_since = None
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def __enter__(self):
+        self.before_call()
+        self._calls.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.record_success(time.time() - self._calls.started)
+        elif issubclass(exc_type, self.exceptions):
+            self.record_failure()
+        return False
+
+    def _update(self, now=None):
+        if self._state == self.OPEN and (now or time.time()) >= self.opened_at + self.cooldown:
+            self._set_state(self.HALF_OPEN)
+
+    def _set_state(self, state):
+        old_state, self._state = self._state, state
+        if state == self.OPEN:
+            logger.warning("Circuit breaker %r opened after %d failures.", self.name,
+                           self.failures)
+        else:
+            logger.info("Circuit breaker %r is %s.", self.name, state)
+        (self.bus or cherrypy.engine).publish("circuit_breaker", self.name, old_state, state)
+
+    def __repr__(self):
+        return "CircuitBreaker(%r, state=%r)" % (self.name, self._state)
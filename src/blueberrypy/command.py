@@ -12,11 +12,12 @@ options:
 
 
 The list of possible commands are:
-    help     print this help or a command's if an argument is given
-    create   create a project skeleton
-    console  blueberrypy REPL for experimentations
-    bundle   bundles up web assets (type 'blueberrypy help bundle' for details)
-    serve    spawn a new CherryPy server process
+    help        print this help or a command's if an argument is given
+    create      create a project skeleton
+    console     blueberrypy REPL for experimentations
+    bundle      bundles up web assets (type 'blueberrypy help bundle' for details)
+    serve       spawn a new CherryPy server process
+    memprofile  print the report of the memory_profile tool
 
 
 See 'blueberrypy help COMMAND' for more information on a specific command.
@@ -206,7 +207,8 @@ def bundle(**kwargs):
 
     options:
       -h, --help   show this help message and exit
-      -b, --build  build the asset bundles
+      -b, --build  build the asset bundles and gzip compressed copies of the
+                   text static files
       -w, --watch  automatically rebuild the asset bundles upon changes in the
                    static directory
       -c, --clean  delete the generated asset bundles
@@ -227,12 +229,47 @@ def bundle(**kwargs):
             assets_cli.build()
         except AttributeError:
             assets_cli.rebuild()
+        precompress_static_files(assets_env.directory)
     elif kwargs.get("watch"):
         assets_cli.watch()
     elif kwargs.get("clean"):
         assets_cli.clean()
 
 
+PRECOMPRESSED_EXTENSIONS = frozenset([".css", ".js", ".json", ".html", ".htm", ".svg",
+                                      ".txt", ".xml", ".map"])
+
+
+def precompress_static_files(directory, extensions=PRECOMPRESSED_EXTENSIONS,
+                             compress_level=9):
+    """Writes a gzip compressed `.gz` sibling of every text file under
+    `directory` whose sibling is missing or older than the file itself. These
+    are served by the `compress` tool instead of compressing the files on
+    every request.
+    """
+    import gzip
+    import shutil
+
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() not in extensions:
+                continue
+
+            path = os.path.join(dirpath, filename)
+            gzipped = path + ".gz"
+            mtime = os.stat(path).st_mtime
+            if os.path.exists(gzipped) and os.stat(gzipped).st_mtime >= mtime:
+                continue
+
+            with open(path, "rb") as src:
+                dest = gzip.GzipFile(gzipped, "wb", compress_level, mtime=mtime)
+                try:
+                    shutil.copyfileobj(src, dest)
+                finally:
+                    dest.close()
+            logger.info("Compressed %s", path)
+
+
 def serve(**kwargs):
     """
     Spawn a new running Cherrypy process
@@ -287,6 +324,9 @@ def serve(**kwargs):
         from blueberrypy.tools import SQLAlchemySessionTool
         cherrypy.tools.orm_session = SQLAlchemySessionTool()
 
+    from blueberrypy.tools import register_tools
+    register_tools(redis=config.use_redis)
+
     if config.use_jinja2:
         if config.webassets_env:
             configure_jinja2(assets_env=config.webassets_env,
@@ -410,6 +450,59 @@ def console(**kwargs):
                                      environment=environment)).interact(banner)
 
 
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "%+.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%+.1f GiB" % size
+
+
+def memprofile(**kwargs):
+    """
+    Print the per route allocation sites aggregated by the memory_profile tool.
+
+    usage: blueberrypy memprofile [options] [REPORT]
+
+    REPORT defaults to the default report file of the memory_profile tool.
+
+    options:
+      -h, --help               show this help message and exit
+      -n TOP, --top TOP        the number of allocation sites to print per route
+                               [default: 10]
+      -r ROUTE, --route ROUTE  only print the routes containing ROUTE
+
+    """
+
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+    from blueberrypy.tools import DEFAULT_MEMORY_PROFILE_REPORT
+
+    report_file = kwargs.get("REPORT") or DEFAULT_MEMORY_PROFILE_REPORT
+    try:
+        with open(report_file) as f:
+            report = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Unable to read memory profile report %s: %s" % (report_file, e))
+        sys.exit(1)
+
+    top = int(kwargs.get("top") or 10)
+    route_filter = kwargs.get("route")
+
+    routes = sorted(report.items(), key=lambda item: sum(
+        [site["size_diff"] for site in item[1]["sites"]]), reverse=True)
+    for route, profile in routes:
+        if route_filter and route_filter not in route:
+            continue
+        logger.info("%s (%d sampled requests)" % (route, profile["requests"]))
+        for site in profile["sites"][:top]:
+            logger.info("    %12s %+8d blocks  %s" % (_format_size(site["size_diff"]),
+                                                      site["count_diff"], site["site"]))
+
+
 def main():
     args = docopt(__doc__, options_first=True)
     config_dir = args["--config-dir"]
@@ -430,8 +523,11 @@ def main():
             doc, callback = bundle.__doc__, bundle
         elif command == "serve":
             doc, callback = serve.__doc__, serve
+        elif command == "memprofile":
+            doc, callback = memprofile.__doc__, memprofile
         elif command == "help":
-            if command_args and command_args[0] in ["create", "console", "bundle", "serve"]:
+            if command_args and command_args[0] in ["create", "console", "bundle", "serve",
+                                                    "memprofile"]:
                 callback = globals()[command_args[0]]
                 doc = callback.__doc__
             else:
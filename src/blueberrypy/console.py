@@ -36,7 +36,8 @@ class Console(InteractiveConsole):
         config = self.config.sqlalchemy_config
 
         if prefix in config:
-            section = config[prefix]
+            section = dict(config[prefix])
+            section.pop("statement_cache_size", None)
             from sqlalchemy.engine import engine_from_config
             return engine_from_config(section, '')
         else:
@@ -47,6 +48,8 @@ class Console(InteractiveConsole):
                     model_fqn_parts = model_fqn.rsplit('.', 1)
                     model_mod = __import__(model_fqn_parts[0], globals(), locals(), [model_fqn_parts[1]])
                     model = getattr(model_mod, model_fqn_parts[1])
+                    section = dict(section)
+                    section.pop("statement_cache_size", None)
                     engine_bindings[model] = engine_from_config(section)
             return engine_bindings
 
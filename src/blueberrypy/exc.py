@@ -1,5 +1,37 @@
+import math
+
+import cherrypy
+
+
 class BlueberryPyNotConfiguredError(Exception):
     pass
 
 class BlueberryPyConfigurationError(Exception):
     pass
+
+
+class RetryAfterHTTPError(cherrypy.HTTPError):
+    """An HTTPError that tells the client when to retry in a `Retry-After`
+    header, which CherryPy would otherwise strip from error responses.
+    """
+
+    def __init__(self, status=503, retry_after=None, message=None):
+        cherrypy.HTTPError.__init__(self, status, message)
+        self.retry_after = retry_after
+
+    def set_response(self):
+        cherrypy.HTTPError.set_response(self)
+        if self.retry_after is not None:
+            cherrypy.serving.response.headers["Retry-After"] = str(self.retry_after)
+
+
+class CircuitOpenError(RetryAfterHTTPError):
+    """Raised instead of calling a dependency whose circuit breaker is open.
+    Unhandled, it results in a 503 response with a `Retry-After` header of the
+    time left before the breaker lets a call through again.
+    """
+
+    def __init__(self, name, retry_in):
+        RetryAfterHTTPError.__init__(self, 503, retry_after=int(math.ceil(max(retry_in, 0))),
+                                     message="%s is unavailable." % name)
+        self.name = name
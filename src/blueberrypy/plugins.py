@@ -1,15 +1,24 @@
+import collections
 import logging
 import textwrap
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 try:
     from logging.config import dictConfig
 except ImportError:
     from logutils.dictconfig import dictConfig
 
+import cherrypy
 from cherrypy.process.plugins import SimplePlugin
 
 
-__all__ = ['LoggingPlugin', 'SQLAlchemyPlugin']
+__all__ = ['LoggingPlugin', 'SQLAlchemyPlugin', 'StatementCache']
 
 
 class LoggingPlugin(SimplePlugin):
@@ -37,6 +46,66 @@ class LoggingPlugin(SimplePlugin):
         logging.shutdown()
 
 
+class StatementCache(object):
+    """A thread-safe LRU cache of compiled SQL statements that counts its hits
+    and misses.
+
+    Instances are given to SQLAlchemy engines as the `compiled_cache`
+    execution option. SQLAlchemy keys the cache on the statement object, so
+    only Core constructs built once and executed many times hit it.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        # SQLAlchemy < 1.0 tests for membership before getting the item
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._data),
+                    "capacity": self.capacity}
+
+
 class SQLAlchemyPlugin(SimplePlugin):
     """Sets up process-wide SQLAlchemy engines.
 
@@ -46,15 +115,48 @@ class SQLAlchemyPlugin(SimplePlugin):
 
     In the future in case we ever get to horizontal sharding, this plugin will
     need to be updated.
+
+    If `slow_query_threshold` (in seconds) is set, every statement executed on
+    the configured engines that takes at least that long is logged with its
+    bound parameters, the request path and the elapsed time. The last
+    `slow_query_history` records are kept in `slow_queries`. If
+    `slow_query_explain` is also True, the database's EXPLAIN plan of slow
+    SELECT statements is captured on a background thread, so the request
+    isn't slowed down, and attached to the record under the `explain` key.
+
+    These options can also be set in the global config::
+
+        [global]
+        engine.sqlalchemy.slow_query_threshold = 0.5
+        engine.sqlalchemy.slow_query_explain = True
+
+    An engine section may contain a `statement_cache_size` key. If it does,
+    `cached_engines` maps the section name to a branch of its engine that
+    compiles statements through a `StatementCache` of that size, whose hit and
+    miss counts are returned by `statement_cache_stats()`. The cache is keyed
+    on statement objects, so it only helps Core constructs built once and
+    executed many times, such as a module-level `select()`. ORM queries build
+    a new statement each time and would never hit it, which is why the engines
+    bound to sessions don't use the cache.
     """
 
-    def __init__(self, bus, config, prefix="sqlalchemy_engine"):
+    def __init__(self, bus, config, prefix="sqlalchemy_engine", slow_query_threshold=None,
+                 slow_query_explain=False, slow_query_history=100):
         SimplePlugin.__init__(self, bus)
         self.config = config
         self.prefix = prefix
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_explain = slow_query_explain
+        self.slow_queries = collections.deque(maxlen=slow_query_history)
+        self.statement_caches = {}
+        self.cached_engines = {}
+        self._explain_queue = None
+        self._explain_thread = None
 
     def start(self):
         self._configure_engines()
+        if self.slow_query_threshold is not None:
+            self._start_slow_query_recorder()
         self.bus.log("SQLAlchemy Plugin started")
     start.priority = 83
 
@@ -68,7 +170,119 @@ class SQLAlchemyPlugin(SimplePlugin):
             engine = self.engine
             self.bus.log("Disposing SQLAlchemy engine %s ..." % engine.url)
             engine.dispose()
-    stop = graceful
+
+    def stop(self):
+        self._stop_slow_query_recorder()
+        for section_name, stats in sorted(self.statement_cache_stats().viewitems()):
+            self.bus.log("Statement cache of %s: %r" % (section_name, stats))
+        self.graceful()
+
+    def statement_cache_stats(self):
+        """Returns a mapping of engine section names to the hit and miss
+        statistics of their statement caches.
+        """
+        return dict([(section_name, cache.stats())
+                     for section_name, cache in self.statement_caches.viewitems()])
+
+    def _engines(self):
+        if hasattr(self, "engine_bindings"):
+            return list(self.engine_bindings.viewvalues())
+        elif hasattr(self, "engine"):
+            return [self.engine]
+        return []
+
+    def _start_slow_query_recorder(self):
+        from sqlalchemy import event
+
+        for engine in self._engines():
+            if not event.contains(engine, "after_cursor_execute", self._after_cursor_execute):
+                event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+        if self.slow_query_explain and self._explain_thread is None:
+            self._explain_queue = queue.Queue(maxsize=100)
+            self._explain_thread = threading.Thread(target=self._explain_slow_queries,
+                                                    name="SQLAlchemyPlugin EXPLAIN")
+            self._explain_thread.daemon = True
+            self._explain_thread.start()
+
+        self.bus.log("Recording SQLAlchemy queries slower than %ss" % self.slow_query_threshold)
+
+    def _stop_slow_query_recorder(self):
+        if self._explain_thread is not None:
+            self._explain_queue.put(None)
+            self._explain_thread.join(5)
+            self._explain_thread = None
+            self._explain_queue = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context,
+                               executemany):
+        if context is not None:
+            context._blueberrypy_slow_query_start_time = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context,
+                              executemany):
+        start_time = getattr(context, "_blueberrypy_slow_query_start_time", None)
+        if start_time is None or self.slow_query_threshold is None:
+            return
+
+        elapsed = time.time() - start_time
+        if elapsed < self.slow_query_threshold:
+            return
+
+        request = cherrypy.serving.request
+        path = request.script_name + request.path_info if request.app is not None else None
+
+        record = {"statement": statement,
+                  "parameters": parameters,
+                  "path": path,
+                  "elapsed": elapsed,
+                  "explain": None}
+        self.slow_queries.append(record)
+        self.bus.log("Slow query (%.3fs) at %s: %s %r" % (elapsed, path, statement, parameters),
+                     level=30)
+
+        is_select = statement.lstrip()[:6].upper() == "SELECT"
+        if self._explain_queue is not None and is_select and not executemany:
+            try:
+                self._explain_queue.put_nowait((conn.engine, statement, parameters, record))
+            except queue.Full:
+                pass
+
+    def _explain_slow_queries(self):
+        explain_queue = self._explain_queue
+        while True:
+            item = explain_queue.get()
+            try:
+                if item is None:
+                    break
+                engine, statement, parameters, record = item
+                try:
+                    record["explain"] = self._explain(engine, statement, parameters)
+                except Exception:
+                    self.bus.log("Unable to EXPLAIN slow query: %s" % statement, level=30,
+                                 traceback=True)
+            finally:
+                explain_queue.task_done()
+
+    def _explain(self, engine, statement, parameters):
+        if engine.dialect.name == "sqlite":
+            statement = "EXPLAIN QUERY PLAN " + statement
+        else:
+            statement = "EXPLAIN " + statement
+
+        # the raw DBAPI connection bypasses the engine events, so the EXPLAIN
+        # itself is never recorded
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(statement, parameters)
+                return [tuple(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
 
     def _configure_engines(self):
         """Sets up engine bindings based on the given config.
@@ -96,6 +310,7 @@ class SQLAlchemyPlugin(SimplePlugin):
             # If this section exists, only 1 engine will be configured
             [sqlalchemy_engine]
             url = ...
+            statement_cache_size = 500
 
 
         :py:func: sqlalchemy.engine_from_config
@@ -112,9 +327,12 @@ class SQLAlchemyPlugin(SimplePlugin):
             $ pip install sqlalchemy
             """))
         else:
+            self.statement_caches = {}
+            self.cached_engines = {}
+
             if self.prefix in self.config:
                 section = self.config[self.prefix]
-                self.engine = engine_from_config(section, '')
+                self.engine = self._engine_from_config(engine_from_config, self.prefix, section)
                 self.bus.log("SQLAlchemy engine configured")
             else:
                 engine_bindings = {}
@@ -130,8 +348,23 @@ class SQLAlchemyPlugin(SimplePlugin):
                             self.bus.log(e, level=40)
                         else:
                             model = getattr(model_mod, model_fqn_parts[1])
-                            engine_bindings[model] = engine_from_config(section, '')
+                            engine_bindings[model] = self._engine_from_config(engine_from_config,
+                                                                              section_name,
+                                                                              section)
 
                 self.engine_bindings = engine_bindings
 
                 self.bus.log("SQLAlchemy engines configured")
+
+    def _engine_from_config(self, engine_from_config, section_name, section):
+        section = dict(section)
+        statement_cache_size = section.pop("statement_cache_size", None)
+
+        engine = engine_from_config(section, '')
+
+        if statement_cache_size is not None:
+            cache = StatementCache(int(statement_cache_size))
+            self.statement_caches[section_name] = cache
+            self.cached_engines[section_name] = engine.execution_options(compiled_cache=cache)
+
+        return engine
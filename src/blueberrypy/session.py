@@ -12,6 +12,9 @@ from pprint import pformat
 
 from cherrypy.lib.sessions import Session
 from redis import StrictRedis as _RedisClient
+from redis.exceptions import RedisError
+
+from blueberrypy.circuit_breaker import CircuitBreaker
 
 
 __all__ = ["RedisSession"]
@@ -38,10 +41,28 @@ class RedisSession(Session):
 
     debug = False
 
+    circuit_breaker = None
+
     @classmethod
     def setup(cls, **kwargs):
+        """Connects to Redis with `kwargs`.
+
+        Calls to Redis are guarded by a circuit breaker which opens after
+        `circuit_breaker_threshold` consecutive errors or calls slower than
+        `circuit_breaker_slow_call` seconds, if given, and then fails requests
+        using sessions fast with a 503 response for `circuit_breaker_cooldown`
+        seconds. Setting a `socket_timeout` turns a hanging Redis server into
+        errors too.
+        """
 
         cls.prefix = normalize_sep(kwargs.pop("prefix", cls.prefix))
+        cls.circuit_breaker = CircuitBreaker(
+            "redis-session",
+            failure_threshold=kwargs.pop("circuit_breaker_threshold", 5),
+            cooldown=kwargs.pop("circuit_breaker_cooldown", 30),
+            slow_call_threshold=kwargs.pop("circuit_breaker_slow_call", None),
+            exceptions=(RedisError,))
+        CircuitBreaker.registry[cls.circuit_breaker.name] = cls.circuit_breaker
 
         for k, v in kwargs.viewitems():
             setattr(cls, k, v)
@@ -52,11 +73,16 @@ class RedisSession(Session):
         else:
             logger.info("Redis server ready.")
 
+    def _call(self, func, *args):
+        if self.circuit_breaker is None:
+            return func(*args)
+        return self.circuit_breaker.call(func, *args)
+
     def _exists(self):
-        return self.cache.exists(self.prefix + self.id)
+        return self._call(self.cache.exists, self.prefix + self.id)
 
     def _load(self):
-        data = self.cache.get(self.prefix + self.id)
+        data = self._call(self.cache.get, self.prefix + self.id)
         if data:
             return pickle.loads(data)
 
@@ -65,13 +91,13 @@ class RedisSession(Session):
         seconds = int(math.ceil((expiration_time - datetime.now()).total_seconds()))
         data = pickle.dumps((self._data, expiration_time), pickle.HIGHEST_PROTOCOL)
 
-        reply = self.cache.setex(key, seconds, data)
+        reply = self._call(self.cache.setex, key, seconds, data)
         if not reply:
             logger.error("Redis didn't reply for SETEX '{0}' '{1}' data".format(
                 key, seconds))
 
     def _delete(self):
-        self.cache.delete(self.prefix + self.id)
+        self._call(self.cache.delete, self.prefix + self.id)
 
     def acquire_lock(self):
         """Acquire an exclusive lock on the currently-loaded session data."""
@@ -7,7 +7,7 @@ from blueberrypy import email
 from blueberrypy.plugins import LoggingPlugin
 from blueberrypy.session import RedisSession
 from blueberrypy.plugins import SQLAlchemyPlugin
-from blueberrypy.tools import SQLAlchemySessionTool
+from blueberrypy.tools import SQLAlchemySessionTool, register_tools
 from blueberrypy.template_engine import configure_jinja2
 
 
@@ -36,6 +36,8 @@ class ControllerTestCase(CPWebCase):
                                                           config=config.sqlalchemy_config)
             cherrypy.tools.orm_session = SQLAlchemySessionTool()
 
+        register_tools(redis=config.use_redis)
+
         if config.use_jinja2:
             if config.webassets_env:
                 configure_jinja2(assets_env=config.webassets_env,
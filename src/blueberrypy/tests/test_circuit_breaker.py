@@ -0,0 +1,72 @@
+import time
+import unittest
+
+from cherrypy.process.wspbus import Bus
+
+from blueberrypy.circuit_breaker import CircuitBreaker
+from blueberrypy.exc import CircuitOpenError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = Bus()
+        self.transitions = []
+        self.bus.subscribe("circuit_breaker",
+                           lambda name, old, new: self.transitions.append((name, old, new)))
+        self.breaker = CircuitBreaker("test", failure_threshold=2, cooldown=0.1, bus=self.bus)
+
+    def failing(self):
+        raise ValueError()
+
+    def test_trip_and_recover(self):
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+        self.assertRaises(ValueError, self.breaker.call, self.failing)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertRaises(ValueError, self.breaker.call, self.failing)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+        try:
+            self.breaker.call(lambda: 1)
+        except CircuitOpenError as e:
+            self.assertEqual(503, e.status)
+            self.assertEqual(1, e.retry_after)
+        else:
+            self.fail("CircuitOpenError not raised")
+
+        time.sleep(0.1)
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertEqual(1, self.breaker.call(lambda: 1))
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+        self.assertEqual([("test", "closed", "open"),
+                          ("test", "open", "half-open"),
+                          ("test", "half-open", "closed")], self.transitions)
+
+    def test_half_open_probe(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.1)
+
+        self.breaker.before_call()
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+    def test_slow_calls(self):
+        breaker = CircuitBreaker("slow", failure_threshold=1, slow_call_threshold=0.01,
+                                 bus=self.bus)
+        breaker.call(time.sleep, 0.02)
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+
+    def test_unexpected_exceptions(self):
+        breaker = CircuitBreaker("io", failure_threshold=1, exceptions=(IOError,), bus=self.bus)
+        self.assertRaises(ValueError, breaker.call, self.failing)
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_registry(self):
+        breaker = CircuitBreaker.get("registered", bus=self.bus)
+        self.assertIs(breaker, CircuitBreaker.get("registered"))
+        self.assertIs(breaker, CircuitBreaker.registry["registered"])
@@ -1,8 +1,13 @@
 import __builtin__ as builtins
 import datetime
 import os.path
+import gzip
+import json
+import logging
 import re
+import shutil
 import sys
+import tempfile
 import unittest
 import textwrap
 
@@ -16,7 +21,7 @@ from flexmock import flexmock, flexmock_teardown
 from yaml import load as load_yaml
 
 import blueberrypy
-from blueberrypy.command import main, get_answer
+from blueberrypy.command import main, get_answer, precompress_static_files
 
 current_year = datetime.datetime.utcnow().year
 
@@ -585,3 +590,60 @@ class ServeCommandTest(unittest.TestCase):
             self.assertEqual(cherrypy.server.bind_addr, ("0.0.0.0", 9090))
         finally:
             cherrypy.engine.start = old_cherrypy_engine_start
+
+
+class PrecompressStaticFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "css"))
+        with open(os.path.join(self.directory, "css", "site.css"), "w") as f:
+            f.write("body { color: black; }\n" * 100)
+        with open(os.path.join(self.directory, "logo.png"), "w") as f:
+            f.write("not text")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_precompress_static_files(self):
+        precompress_static_files(self.directory)
+
+        css = os.path.join(self.directory, "css", "site.css")
+        gzipped = gzip.GzipFile(css + ".gz")
+        try:
+            self.assertEqual(open(css).read(), gzipped.read())
+        finally:
+            gzipped.close()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "logo.png.gz")))
+
+        mtime = os.stat(css + ".gz").st_mtime
+        precompress_static_files(self.directory)
+        self.assertEqual(mtime, os.stat(css + ".gz").st_mtime)
+
+
+class MemprofileCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.report_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            json.dump({"GET /users": {"requests": 2,
+                                      "sites": [{"site": "app.py:10", "size_diff": 2048,
+                                                 "count_diff": 4},
+                                                {"site": "app.py:20", "size_diff": 100,
+                                                 "count_diff": 1}]},
+                       "GET /": {"requests": 1, "sites": []}}, f)
+
+        self.messages = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.messages.append(record.getMessage())
+        logging.getLogger("blueberrypy.command").addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger("blueberrypy.command").removeHandler(self.handler)
+        os.remove(self.report_file)
+
+    def test_memprofile(self):
+        sys.argv = ("blueberrypy memprofile -n 1 -r users " + self.report_file).split()
+        main()
+        self.assertEqual(["GET /users (2 sampled requests)",
+                          "        +2.0 KiB       +4 blocks  app.py:10"], self.messages)
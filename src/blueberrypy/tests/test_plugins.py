@@ -1,7 +1,13 @@
 import os
+import shutil
+import tempfile
+import unittest
 
+import cherrypy
 from cherrypy.test import helper
 
+from blueberrypy.plugins import SQLAlchemyPlugin
+
 
 class SQLAlchemyPluginTest(helper.CPWebCase):
 
@@ -39,3 +45,68 @@ class SQLAlchemyPluginTest(helper.CPWebCase):
         finally:
             self.getPage("/exit")
         p.join()
+
+
+class SQLAlchemyPluginSlowQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        saconf = {'sqlalchemy_engine': {'url': 'sqlite:///' + os.path.join(self.tmpdir, 'slow.db')}}
+        self.plugin = SQLAlchemyPlugin(cherrypy.engine, saconf, slow_query_threshold=0,
+                                       slow_query_explain=True)
+        self.plugin.start()
+
+    def tearDown(self):
+        self.plugin.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_slow_query_recorder(self):
+        engine = self.plugin.engine
+        engine.execute("CREATE TABLE user (id INTEGER PRIMARY KEY, name TEXT)")
+        engine.execute("SELECT name FROM user WHERE id = ?", 1)
+        self.plugin._explain_queue.join()
+
+        record = self.plugin.slow_queries[-1]
+        self.assertEqual("SELECT name FROM user WHERE id = ?", record["statement"])
+        self.assertEqual((1,), tuple(record["parameters"]))
+        self.assertIsNone(record["path"])
+        self.assertGreaterEqual(record["elapsed"], 0)
+        self.assertTrue(record["explain"])
+        self.assertIsNone(self.plugin.slow_queries[0]["explain"])
+
+    def test_slow_query_threshold(self):
+        self.plugin.slow_query_threshold = 60
+        self.plugin.engine.execute("SELECT 1")
+        self.assertEqual(0, len(self.plugin.slow_queries))
+
+
+class SQLAlchemyPluginStatementCacheTest(unittest.TestCase):
+
+    def test_statement_cache_stats(self):
+        saconf = {'sqlalchemy_engine': {'url': 'sqlite://', 'statement_cache_size': 10}}
+        plugin = SQLAlchemyPlugin(cherrypy.engine, saconf)
+        plugin.start()
+        try:
+            from sqlalchemy import literal, select
+            stmt = select([literal(1)])
+            engine = plugin.cached_engines['sqlalchemy_engine']
+            engine.execute(stmt)
+            engine.execute(stmt)
+            stats = plugin.statement_cache_stats()
+            self.assertEqual({'sqlalchemy_engine': {'hits': 1, 'misses': 1,
+                                                    'size': 1, 'capacity': 10}}, stats)
+
+            # the engine bound to sessions doesn't go through the cache
+            plugin.engine.execute(stmt)
+            self.assertEqual(stats, plugin.statement_cache_stats())
+        finally:
+            plugin.stop()
+
+    def test_no_statement_cache(self):
+        plugin = SQLAlchemyPlugin(cherrypy.engine, {'sqlalchemy_engine': {'url': 'sqlite://'}})
+        plugin.start()
+        try:
+            self.assertEqual({}, plugin.statement_cache_stats())
+            self.assertEqual({}, plugin.cached_engines)
+        finally:
+            plugin.stop()
@@ -1,5 +1,19 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:
+    pass
 
 try:
     import simplejson as json
@@ -8,15 +22,24 @@ except ImportError:
 
 import cherrypy
 from cherrypy import HTTPError, HTTPRedirect
+from cherrypy._cptools import Toolbox
+from cherrypy.lib import static
+from cherrypy.lib.encoding import decompress
 from cherrypy.test import helper
 
 from sqlalchemy import Column, Integer, Unicode, engine_from_config
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
 from testconfig import config as testconfig
 
+from blueberrypy.circuit_breaker import CircuitBreaker
 from blueberrypy.plugins import SQLAlchemyPlugin
-from blueberrypy.tools import MultiHookPointTool, SQLAlchemySessionTool
+from blueberrypy.tools import (MultiHookPointTool, RequestTimingTool, SQLAlchemySessionTool,
+                               LatencyHistogram, ResponseCacheTool, MemoryResponseStorage,
+                               CompressionTool, RateLimitTool, SingleFlightTool,
+                               StaticAssetTool, MemoryProfileTool, register_tools,
+                               stream_json, tracemalloc_support)
 
 
 def get_config(section_name):
@@ -92,6 +115,21 @@ class MultiHookPointToolTest(helper.CPWebCase, unittest.TestCase):
                                   "tools.test_multi_hook_point.on_end_resource.param": 13,
                                   "tools.test_multi_hook_point.on_end_request.param": 19}
 
+            @cherrypy.expose
+            def priorities(self):
+                hooks = cherrypy.request.hooks
+                return " ".join([str(hook.priority)
+                                 for hook_point in ("before_handler", "before_finalize")
+                                 for hook in hooks[hook_point]
+                                 if hook.callback.__name__ == hook_point])
+            priorities._cp_config = {"tools.test_multi_hook_point.priority": 10,
+                                     "tools.test_multi_hook_point.before_finalize.priority": 80}
+
+            @cherrypy.expose
+            def listed(self):
+                return "listed"
+            listed._cp_config = {"tools.test_multi_hook_point.on_end_request.param": [1, 2]}
+
             @cherrypy.expose
             def failure(self):
                 return 1 / 0
@@ -113,6 +151,613 @@ class MultiHookPointToolTest(helper.CPWebCase, unittest.TestCase):
         self.assertHeader("x-before-error-response", str(7))
         self.assertHeader("x-after-error-response", str(8))
 
+    def test_hook_plan(self):
+        tool = cherrypy.tools.test_multi_hook_point
+        plan = tool._compile_hook_plan({"priority": 10,
+                                        "before_handler.priority": 80,
+                                        "before_handler.param": 4})
+        plan = dict([(hook_point, (priority, hook_conf))
+                     for hook_point, _, priority, hook_conf in plan])
+        self.assertEqual((80, {"param": 4}), plan["before_handler"])
+        self.assertEqual((None, {}), plan["on_start_resource"])
+
+    def test_hook_priority(self):
+        self.getPage("/priorities")
+        self.assertBody("50 80")
+
+    def test_hook_plan_cache(self):
+        tool = cherrypy.tools.test_multi_hook_point
+        tool._hook_plans.clear()
+        self.getPage("/success")
+        self.getPage("/success")
+        self.getPage("/failure")
+        self.assertEqual(2, len(tool._hook_plans))
+
+        # configs with lists are cached by their contents too
+        self.getPage("/listed")
+        self.getPage("/listed")
+        self.assertEqual(3, len(tool._hook_plans))
+
+
+class RequestTimingToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.request_timing.on": True}
+
+            @cherrypy.expose
+            def index(self):
+                return "hello"
+
+            @cherrypy.expose
+            def no_header(self):
+                return "hello"
+            no_header._cp_config = {"tools.request_timing.before_finalize.header": False}
+
+        cherrypy.tools.request_timing = RequestTimingTool()
+        cherrypy.tree.mount(Root())
+
+    def test_server_timing(self):
+        self.getPage("/")
+        self.assertStatus(200)
+        server_timing = dict(self.headers).get("Server-Timing")
+        self.assertIsNotNone(server_timing)
+        phases = [metric.split(";")[0] for metric in server_timing.split(", ")]
+        self.assertEqual(["start", "body", "handler"], phases)
+
+        self.getPage("/no_header")
+        self.assertNoHeader("Server-Timing")
+
+    def test_histograms(self):
+        tool = cherrypy.tools.request_timing
+        self.getPage("/")
+
+        # on_end_request runs after the response has been sent
+        for _ in range(100):
+            if tool.snapshot()["total"]["count"]:
+                break
+            time.sleep(0.01)
+
+        snapshot = tool.snapshot()
+        self.assertEqual(set(["start", "body", "handler", "finalize", "total"]),
+                         set(snapshot.keys()))
+        self.assertTrue(snapshot["total"]["count"] >= 1)
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(buckets=[1, 10, float("inf")])
+        for value in (0.5, 5, 50, 7):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(4, snapshot["count"])
+        self.assertEqual(62.5, snapshot["sum"])
+        self.assertEqual([(1, 1), (10, 3), (float("inf"), 4)], snapshot["buckets"])
+
+
+class ResponseCacheToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.response_cache.on": True}
+
+            calls = 0
+
+            @cherrypy.expose
+            def index(self):
+                Root.calls += 1
+                cherrypy.tools.response_cache.tag("index")
+                return "hello %d" % Root.calls
+
+            @cherrypy.expose
+            def invalidate(self):
+                cherrypy.tools.response_cache.invalidate("index")
+                return "invalidated"
+
+            @cherrypy.expose
+            def lang(self):
+                Root.calls += 1
+                return cherrypy.request.headers.get("Accept-Language", "")
+            lang._cp_config = {"tools.response_cache.before_handler.vary": ["Accept-Language"]}
+
+            @cherrypy.expose
+            def user(self):
+                return cherrypy.request.headers.get("Cookie", "")
+
+            @cherrypy.expose
+            def shared(self):
+                return cherrypy.request.headers.get("Cookie", "")
+            shared._cp_config = {"tools.response_cache.before_handler.shared": True}
+
+        cherrypy.tools.response_cache = ResponseCacheTool()
+        cherrypy.tree.mount(Root())
+
+    def setUp(self):
+        cherrypy.tools.response_cache.storage.clear()
+
+    def test_cache_hit(self):
+        self.getPage("/")
+        self.assertStatus(200)
+        body = self.body
+        etags = [v for k, v in self.headers if k.lower() == "etag"]
+        self.assertEqual(1, len(etags))
+        etag = etags[0]
+
+        self.getPage("/")
+        self.assertStatus(200)
+        self.assertBody(body)
+        self.assertHeader("ETag", etag)
+
+        self.getPage("/", headers=[("If-None-Match", etag)])
+        self.assertStatus(304)
+        self.assertBody("")
+
+        self.getPage("/invalidate")
+        self.getPage("/")
+        self.assertStatus(200)
+        self.assertNotEqual(body, self.body)
+
+    def test_vary(self):
+        self.getPage("/lang", headers=[("Accept-Language", "en")])
+        self.assertBody("en")
+        self.getPage("/lang", headers=[("Accept-Language", "fr")])
+        self.assertBody("fr")
+        self.assertHeader("Vary", "Accept-Language")
+
+    def test_credentials(self):
+        self.getPage("/user", headers=[("Cookie", "user=1")])
+        self.assertBody("user=1")
+        self.getPage("/user", headers=[("Cookie", "user=2")])
+        self.assertBody("user=2")
+        self.getPage("/user", headers=[("Authorization", "Basic Zm9vOmJhcg==")])
+        self.assertBody("")
+
+        self.getPage("/shared", headers=[("Cookie", "user=1")])
+        self.getPage("/shared", headers=[("Cookie", "user=2")])
+        self.assertBody("user=1")
+
+    def test_etag_on_miss(self):
+        etag = '"%s"' % hashlib.sha1(b"en").hexdigest()
+        self.getPage("/lang", headers=[("Accept-Language", "en"), ("If-None-Match", etag)])
+        self.assertStatus(304)
+        self.assertHeader("ETag", etag)
+
+        self.getPage("/lang", headers=[("Accept-Language", "en")])
+        self.assertStatus(200)
+        self.assertBody("en")
+
+    def test_memory_storage(self):
+        storage = MemoryResponseStorage(maxsize=2)
+        storage.set("a", 1, 60, tags=["x"])
+        storage.set("b", 2, 60)
+        self.assertEqual(1, storage.get("a"))
+        storage.set("c", 3, 60, tags=["x"])
+        self.assertIsNone(storage.get("b"))
+        storage.invalidate_tags(["x"])
+        self.assertIsNone(storage.get("a"))
+        self.assertIsNone(storage.get("c"))
+        storage.set("d", 4, -1)
+        self.assertIsNone(storage.get("d"))
+
+
+class CompressionToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+
+        cls.static_dir = tempfile.mkdtemp()
+
+        super(CompressionToolTest, cls).setup_class()
+    setUpClass = setup_class
+
+    @classmethod
+    def teardown_class(cls):
+
+        super(CompressionToolTest, cls).teardown_class()
+
+        shutil.rmtree(cls.static_dir)
+    tearDownClass = teardown_class
+
+    @staticmethod
+    def setup_server():
+
+        text = "hello world " * 100
+        static_dir = CompressionToolTest.static_dir
+
+        with open(os.path.join(static_dir, "site.css"), "w") as f:
+            f.write("body { color: black; }\n" * 100)
+        gzipped = gzip.GzipFile(os.path.join(static_dir, "site.css.gz"), "wb")
+        gzipped.write("precompressed")
+        gzipped.close()
+
+        class Root(object):
+
+            _cp_config = {"tools.compress.on": True}
+
+            @cherrypy.expose
+            def index(self):
+                return text
+
+            @cherrypy.expose
+            def stream(self):
+                for _ in range(10):
+                    yield text
+            stream._cp_config = {"response.stream": True}
+
+            @cherrypy.expose
+            def small(self):
+                return "hello"
+
+            @cherrypy.expose
+            def binary(self):
+                cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+                return text
+
+        cherrypy.tools.compress = CompressionTool()
+        cherrypy.tools.static_asset_dir = StaticAssetTool(static.staticdir)
+        cherrypy.tree.mount(Root(), config={
+            "/static": {"tools.staticdir.on": True,
+                        "tools.staticdir.dir": static_dir},
+            "/assets": {"tools.static_asset_dir.on": True,
+                        "tools.static_asset_dir.section": "/assets",
+                        "tools.static_asset_dir.dir": static_dir}})
+
+    def test_gzip(self):
+        self.getPage("/", headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus(200)
+        self.assertHeader("Content-Encoding", "gzip")
+        self.assertHeader("Vary", "Accept-Encoding")
+        self.assertEqual("hello world " * 100, decompress(self.body))
+
+        self.getPage("/stream", headers=[("Accept-Encoding", "gzip")])
+        self.assertHeader("Content-Encoding", "gzip")
+        self.assertEqual("hello world " * 1000, decompress(self.body))
+
+    def test_deflate(self):
+        self.getPage("/", headers=[("Accept-Encoding", "deflate, gzip;q=0.5")])
+        self.assertHeader("Content-Encoding", "deflate")
+        self.assertEqual("hello world " * 100, zlib.decompress(self.body))
+
+    def test_no_compression(self):
+        self.getPage("/")
+        self.assertNoHeader("Content-Encoding")
+
+        self.getPage("/", headers=[("Accept-Encoding", "gzip;q=0")])
+        self.assertNoHeader("Content-Encoding")
+
+        self.getPage("/small", headers=[("Accept-Encoding", "gzip")])
+        self.assertNoHeader("Content-Encoding")
+        self.assertBody("hello")
+
+        self.getPage("/binary", headers=[("Accept-Encoding", "gzip")])
+        self.assertNoHeader("Content-Encoding")
+
+    def test_precompressed(self):
+        self.getPage("/static/site.css", headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus(200)
+        self.assertHeader("Content-Encoding", "gzip")
+        self.assertHeader("Content-Type", "text/css")
+        self.assertEqual("precompressed", decompress(self.body))
+
+        self.getPage("/assets/site.css", headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus(200)
+        self.assertHeader("Content-Encoding", "gzip")
+        self.assertEqual("precompressed", decompress(self.body))
+
+
+class FakeRedisPipeline(object):
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.commands = []
+
+    def incrby(self, key, amount):
+        self.commands.append((key, amount))
+
+    def expire(self, key, seconds):
+        pass
+
+    def execute(self):
+        results = []
+        for key, amount in self.commands:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            results.append(self.counters[key])
+        return results
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.counters = {}
+
+    def pipeline(self):
+        return FakeRedisPipeline(self.counters)
+
+
+class RateLimitToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.rate_limit.on": True,
+                          "tools.rate_limit.on_start_resource.limit": 2,
+                          "tools.rate_limit.on_start_resource.period": 3600}
+
+            @cherrypy.expose
+            def index(self):
+                return "hello"
+
+            @cherrypy.expose
+            def other(self):
+                return "hello"
+
+        cherrypy.tools.rate_limit = RateLimitTool()
+        cherrypy.tree.mount(Root())
+
+    def test_rate_limit(self):
+        self.getPage("/")
+        self.assertStatus(200)
+        self.getPage("/")
+        self.assertStatus(200)
+        self.getPage("/")
+        self.assertStatus(429)
+        self.assertHeader("Retry-After", "1800")
+
+        self.getPage("/other")
+        self.assertStatus(200)
+
+    def test_redis_sync(self):
+        tool = RateLimitTool(redis=True)
+        tool._client = FakeRedis()
+        other = RateLimitTool(redis=True)
+        other._client = tool._client
+
+        cherrypy.serving.request.remote.ip = "10.0.0.1"
+        config = dict(limit=4, period=3600, sync_batch=2)
+        tool.on_start_resource(**config)
+        tool.on_start_resource(**config)
+        other.on_start_resource(**config)
+        other.on_start_resource(**config)
+        self.assertEqual([4], list(tool._client.counters.values()))
+        self.assertRaises(HTTPError, other.on_start_resource, **config)
+
+        # the other process finds out about the limit on its next sync
+        tool.on_start_resource(**config)
+        self.assertRaises(HTTPError, tool.on_start_resource, **config)
+        self.assertRaises(HTTPError, tool.on_start_resource, **config)
+
+
+class SingleFlightToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.single_flight.on": True}
+
+            calls = 0
+
+            @cherrypy.expose
+            def index(self):
+                Root.calls += 1
+                calls = Root.calls
+                time.sleep(0.5)
+                return "hello %d" % calls
+
+        cherrypy.tools.single_flight = SingleFlightTool()
+        cherrypy.tree.mount(Root())
+
+    def get_concurrently(self, cookies):
+        bodies = []
+
+        def get(cookie):
+            conn = self.HTTP_CONN(self.HOST, self.PORT)
+            conn.request("GET", "/", headers={"Cookie": cookie} if cookie else {})
+            bodies.append(conn.getresponse().read())
+            conn.close()
+
+        threads = [threading.Thread(target=get, args=(cookie,)) for cookie in cookies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return bodies
+
+    def test_coalescing(self):
+        self.assertEqual(["hello 1"] * 5, self.get_concurrently([None] * 5))
+
+        self.getPage("/")
+        self.assertBody("hello 2")
+
+    def test_credentials(self):
+        bodies = self.get_concurrently(["user=1", "user=2", "user=1"])
+        self.assertEqual(2, len(set(bodies)))
+
+
+class StaticAssetToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+
+        cls.static_dir = tempfile.mkdtemp()
+        for name in ("site.css", "packed.1a2b3c4d.js", "photo-20140101.jpg", "site-v3.css"):
+            with open(os.path.join(cls.static_dir, name), "w") as f:
+                f.write(name)
+
+        super(StaticAssetToolTest, cls).setup_class()
+    setUpClass = setup_class
+
+    @classmethod
+    def teardown_class(cls):
+
+        super(StaticAssetToolTest, cls).teardown_class()
+
+        shutil.rmtree(cls.static_dir)
+    tearDownClass = teardown_class
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+            pass
+
+        cherrypy.tools.static_asset_dir = StaticAssetTool(static.staticdir)
+        cherrypy.tree.mount(Root(), config={
+            "/static": {"tools.static_asset_dir.on": True,
+                        "tools.static_asset_dir.section": "/static",
+                        "tools.static_asset_dir.dir": StaticAssetToolTest.static_dir,
+                        "tools.static_asset_dir.max_age": 120},
+            "/versioned": {"tools.static_asset_dir.on": True,
+                           "tools.static_asset_dir.section": "/versioned",
+                           "tools.static_asset_dir.dir": StaticAssetToolTest.static_dir,
+                           "tools.static_asset_dir.fingerprint": r"-v\d+\.css$"}})
+
+    def test_cache_control(self):
+        self.getPage("/static/packed.1a2b3c4d.js")
+        self.assertStatus(200)
+        self.assertBody("packed.1a2b3c4d.js")
+        self.assertHeader("Cache-Control", "public, max-age=31536000, immutable")
+
+        self.getPage("/static/site.css?0123abcd")
+        self.assertHeader("Cache-Control", "public, max-age=31536000, immutable")
+
+        self.getPage("/static/site.css")
+        self.assertBody("site.css")
+        self.assertHeader("Content-Type", "text/css")
+        self.assertHeader("Cache-Control", "public, max-age=120")
+
+        self.getPage("/static/missing.css")
+        self.assertStatus(404)
+        self.assertNoHeader("Cache-Control")
+
+        # numbers are not fingerprints
+        self.getPage("/static/photo-20140101.jpg")
+        self.assertHeader("Cache-Control", "public, max-age=120")
+        self.getPage("/static/site.css?20140101")
+        self.assertHeader("Cache-Control", "public, max-age=120")
+
+    def test_fingerprint_option(self):
+        self.getPage("/versioned/site-v3.css")
+        self.assertStatus(200)
+        self.assertHeader("Cache-Control", "public, max-age=31536000, immutable")
+
+        self.getPage("/versioned/packed.1a2b3c4d.js")
+        self.assertHeader("Cache-Control", "public, max-age=60")
+
+    def test_file_cache(self):
+        tool = cherrypy.tools.static_asset_dir
+        path = os.path.join(self.static_dir, "site.css")
+
+        self.getPage("/static/site.css")
+        self.assertIn(path, tool.cache._entries)
+
+        with open(path, "w") as f:
+            f.write("changed site.css")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+        self.getPage("/static/site.css")
+        self.assertBody("changed site.css")
+
+
+@unittest.skipUnless(tracemalloc_support, "tracemalloc not available")
+class MemoryProfileToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+
+        fd, cls.report_file = tempfile.mkstemp()
+        os.close(fd)
+
+        super(MemoryProfileToolTest, cls).setup_class()
+    setUpClass = setup_class
+
+    @classmethod
+    def teardown_class(cls):
+
+        super(MemoryProfileToolTest, cls).teardown_class()
+
+        os.remove(cls.report_file)
+    tearDownClass = teardown_class
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.memory_profile.on": True,
+                          "tools.memory_profile.on_start_resource.sample_rate": 1,
+                          "tools.memory_profile.on_end_request.report_file":
+                          MemoryProfileToolTest.report_file}
+
+            leaks = []
+
+            @cherrypy.expose
+            def leak(self, id=None):
+                Root.leaks.append(["x" * 100 for _ in range(1000)])
+                return "leaked"
+
+            @cherrypy.expose
+            def named(self):
+                return "named"
+            named._cp_config = {"tools.memory_profile.on_start_resource.route": "named route"}
+
+        cherrypy.tools.memory_profile = MemoryProfileTool()
+        cherrypy.tree.mount(Root())
+
+    def wait_for_report(self, route, requests):
+        # on_end_request runs after the response has been sent
+        for _ in range(100):
+            with open(self.report_file) as f:
+                content = f.read()
+            report = json.loads(content) if content else {}
+            if report.get(route, {}).get("requests") == requests:
+                break
+            time.sleep(0.01)
+        return report
+
+    def test_memory_profile(self):
+        self.getPage("/leak/1")
+        self.assertStatus(200)
+        self.getPage("/leak/2")
+        self.assertStatus(200)
+
+        # requests are aggregated per handler, not per path
+        route = "GET blueberrypy.tests.test_tools.Root.leak"
+        report = self.wait_for_report(route, 2)
+        self.assertNotIn("GET /leak/1", report)
+        self.assertEqual(2, report[route]["requests"])
+        self.assertTrue(report[route]["sites"])
+
+        # tracing stops once no sampled request is in flight
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_route_name(self):
+        self.getPage("/named")
+        report = self.wait_for_report("GET named route", 1)
+        self.assertEqual(1, report["GET named route"]["requests"])
+
+
+class RegisterToolsTest(unittest.TestCase):
+
+    def test_register_tools(self):
+        toolbox = Toolbox("tools")
+        compress = toolbox.compress = CompressionTool()
+        register_tools(toolbox=toolbox)
+
+        self.assertIs(compress, toolbox.compress)
+        self.assertIsInstance(toolbox.static_asset_dir, StaticAssetTool)
+        self.assertIsInstance(toolbox.response_cache.storage, MemoryResponseStorage)
+        self.assertEqual("stream_json", toolbox.stream_json._name)
+        self.assertFalse(hasattr(toolbox, "staticdir"))
+
 
 class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase):
 
@@ -190,8 +835,56 @@ class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase)
                 return json.dumps({'id': bob.id, 'name': bob.name})
             raise_passable_exception_query.exposed = True
 
+            def profile_queries(self):
+                session = cherrypy.request.orm_session
+                session.query(User).count()
+                session.query(Address).count()
+                return json.dumps(None)
+            profile_queries.exposed = True
+            profile_queries._cp_config = {'tools.orm_session.on_start_resource.profile': True}
+
+            def profile_queries_unsampled(self):
+                session = cherrypy.request.orm_session
+                session.query(User).count()
+                return json.dumps(None)
+            profile_queries_unsampled.exposed = True
+            profile_queries_unsampled._cp_config = {
+                'tools.orm_session.on_start_resource.profile': True,
+                'tools.orm_session.on_start_resource.profile_sample_rate': 0}
+
+            def auto_transaction_save(self, name):
+                session = cherrypy.request.orm_session
+                session.add(User(name=name))
+                return json.dumps(None)
+            auto_transaction_save.exposed = True
+            auto_transaction_save._cp_config = {
+                'tools.orm_session.on_start_resource.transaction_policy': 'auto'}
+
+            def auto_transaction_query(self, name):
+                session = cherrypy.request.orm_session
+                user = session.query(User).filter_by(name=name).first()
+                return json.dumps(user is not None)
+            auto_transaction_query.exposed = True
+            auto_transaction_query._cp_config = {
+                'tools.orm_session.on_start_resource.transaction_policy': 'auto'}
+
+            def stream_users(self):
+                session = cherrypy.request.orm_session
+                return session.query(User).order_by(User.id)
+            stream_users.exposed = True
+            stream_users._cp_config = {'tools.stream_json.on': True,
+                                       'tools.stream_json.yield_per': 1}
+
+            def stream_without_session(self):
+                return "unreachable"
+            stream_without_session.exposed = True
+            stream_without_session._cp_config = {
+                'response.stream': True,
+                'tools.orm_session.on_start_resource.transaction_policy': 'invalid'}
+
         cherrypy.engine.sqlalchemy = SQLAlchemyPlugin(cherrypy.engine, testconfig)
         cherrypy.tools.orm_session = SQLAlchemySessionTool()
+        cherrypy.tools.stream_json = cherrypy.Tool('before_handler', stream_json, priority=30)
         cherrypy.config.update({'engine.sqlalchemy.on': True})
         cherrypy.tree.mount(SingleEngine())
 
@@ -232,6 +925,173 @@ class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase)
         self.assertEqual(u'bob', json_resp['name'])
         self.assertStatus(200)
 
+    def test_profile_queries(self):
+        self.getPage('/profile_queries')
+        self.assertStatus(200)
+        self.assertHeader('X-ORM-Query-Count', '2')
+        self.assertTrue([v for k, v in self.headers if k.lower() == 'x-orm-query-time'])
+
+        self.getPage('/profile_queries_unsampled')
+        self.assertStatus(200)
+        self.assertNoHeader('X-ORM-Query-Count')
+
+    def test_auto_transaction_policy(self):
+        self.getPage('/auto_transaction_save?name=mary', method='POST')
+        self.assertStatus(200)
+        self.getPage('/auto_transaction_query?name=mary')
+        self.assertBody(json.dumps(True))
+
+        self.getPage('/auto_transaction_save?name=nancy')
+        self.assertStatus(200)
+        self.getPage('/auto_transaction_query?name=nancy')
+        self.assertBody(json.dumps(False))
+
+    def test_stream_json(self):
+        self.getPage('/auto_transaction_save?name=oscar', method='POST')
+        self.getPage('/auto_transaction_save?name=peggy', method='POST')
+
+        self.getPage('/stream_users')
+        self.assertStatus(200)
+        self.assertHeader('Content-Type', 'application/json')
+        users = json.loads(self.body)
+        names = [user['name'] for user in users]
+        self.assertIn(u'oscar', names)
+        self.assertIn(u'peggy', names)
+        self.assertEqual(sorted([user['id'] for user in users]), [user['id'] for user in users])
+
+    def test_stream_without_session(self):
+        errors = []
+        handler = logging.Handler()
+        handler.emit = lambda record: errors.append(handler.format(record))
+        cherrypy.log.error_log.addHandler(handler)
+        try:
+            self.getPage('/stream_without_session')
+        finally:
+            cherrypy.log.error_log.removeHandler(handler)
+        self.assertStatus(500)
+        self.assertFalse([error for error in errors if 'AttributeError' in error])
+
+
+class SQLAlchemySessionToolCheckoutTimeoutTest(helper.CPWebCase, unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+
+        cls.tmpdir = tempfile.mkdtemp()
+
+        super(SQLAlchemySessionToolCheckoutTimeoutTest, cls).setup_class()
+    setUpClass = setup_class
+
+    @classmethod
+    def teardown_class(cls):
+
+        super(SQLAlchemySessionToolCheckoutTimeoutTest, cls).teardown_class()
+
+        shutil.rmtree(cls.tmpdir)
+    tearDownClass = teardown_class
+
+    @staticmethod
+    def setup_server():
+
+        class CheckoutTimeout(object):
+
+            _cp_config = {'tools.orm_session.on': True,
+                          'tools.orm_session.on_start_resource.checkout_timeout': 0.1,
+                          'tools.orm_session.on_start_resource.retry_after': 5}
+
+            def index(self):
+                session = cherrypy.request.orm_session
+                return str(session.execute("SELECT 1").scalar())
+            index.exposed = True
+
+            def hold(self):
+                session = cherrypy.request.orm_session
+                SQLAlchemySessionToolCheckoutTimeoutTest.held.set()
+                SQLAlchemySessionToolCheckoutTimeoutTest.release.wait(5)
+                return str(session.execute("SELECT 1").scalar())
+            hold.exposed = True
+
+            def breaker(self):
+                return self.index()
+            breaker.exposed = True
+            breaker._cp_config = {
+                'tools.orm_session.on_start_resource.circuit_breaker': True,
+                'tools.orm_session.on_start_resource.circuit_breaker_threshold': 1,
+                'tools.orm_session.on_start_resource.circuit_breaker_cooldown': 60}
+
+        saconf = {'sqlalchemy_engine': {
+            'url': 'sqlite:///' + os.path.join(SQLAlchemySessionToolCheckoutTimeoutTest.tmpdir,
+                                               'checkout.db'),
+            'connect_args': {'check_same_thread': False},
+            'poolclass': QueuePool,
+            'pool_size': 1,
+            'max_overflow': 0}}
+        cherrypy.engine.sqlalchemy = SQLAlchemyPlugin(cherrypy.engine, saconf)
+        cherrypy.tools.orm_session = SQLAlchemySessionTool()
+        cherrypy.config.update({'engine.sqlalchemy.on': True})
+        cherrypy.tree.mount(CheckoutTimeout())
+
+    def test_checkout_timeout(self):
+        self.getPage('/')
+        self.assertStatus(200)
+        self.assertBody('1')
+
+        conn = cherrypy.engine.sqlalchemy.engine.connect()
+        try:
+            self.getPage('/')
+            self.assertStatus(503)
+            self.assertHeader('Retry-After', '5')
+        finally:
+            conn.close()
+
+        self.getPage('/')
+        self.assertStatus(200)
+
+    def test_checkout_timeout_concurrent(self):
+        cls = SQLAlchemySessionToolCheckoutTimeoutTest
+        cls.held, cls.release = threading.Event(), threading.Event()
+        holder = threading.Thread(target=self.getPage, args=('/hold',))
+        holder.start()
+        try:
+            self.assertTrue(cls.held.wait(5))
+
+            # another request holding the only connection sheds this one
+            # within the checkout timeout instead of the pool timeout
+            conn = self.get_conn()
+            conn.request('GET', '/')
+            started = time.time()
+            response = conn.getresponse()
+            self.assertEqual(503, response.status)
+            self.assertLess(time.time() - started, 1)
+            conn.close()
+        finally:
+            cls.release.set()
+            holder.join()
+
+        self.getPage('/')
+        self.assertStatus(200)
+
+    def test_circuit_breaker(self):
+        conn = cherrypy.engine.sqlalchemy.engine.connect()
+        try:
+            self.getPage('/breaker')
+            self.assertStatus(503)
+            self.assertHeader('Retry-After', '5')
+        finally:
+            conn.close()
+
+        # fails fast until the cooldown is over
+        self.getPage('/breaker')
+        self.assertStatus(503)
+        self.assertHeader('Retry-After', '60')
+
+        breaker = cherrypy.engine.sqlalchemy.engine._blueberrypy_circuit_breaker
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        breaker.reset()
+
+        self.getPage('/breaker')
+        self.assertStatus(200)
+
 
 class SQLAlchemySessionToolTwoPhaseTest(helper.CPWebCase, unittest.TestCase):
 
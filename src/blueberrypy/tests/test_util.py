@@ -5,19 +5,27 @@ import unittest
 from base64 import b64encode
 from datetime import date, time, datetime, timedelta
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 import testconfig
 
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 from shapely.geometry import Point
 from sqlalchemy import (Column, Integer, Date, DateTime, Time, Interval, Enum,
-                        ForeignKey, UnicodeText, engine_from_config)
-from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref
+                        ForeignKey, UnicodeText, engine_from_config, event)
+from sqlalchemy.orm import (sessionmaker, scoped_session, relationship, backref,
+                            configure_mappers)
 from sqlalchemy.ext.declarative import declarative_base
 
+from blueberrypy import util
 from blueberrypy.util import (CSRFToken, pad_block_cipher_message,
                               unpad_block_cipher_message,
-                              from_collection, to_collection)
+                              from_collection, to_collection, to_columns, iter_json,
+                              register_converter)
 
 
 # NOTE: REMEMBER TO SETUP POSTGIS!!!
@@ -89,6 +97,17 @@ class DerivedTestEntity(TestEntity):
     derivedprop = Column(Integer)
 
 
+class Category(Base):
+
+    __tablename__ = "category"
+
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, ForeignKey("category.id"))
+
+    children = relationship("Category", back_populates="parent")
+    parent = relationship("Category", back_populates="children", remote_side=[id])
+
+
 class CSRFTokenTest(unittest.TestCase):
 
     def test_csrftoken(self):
@@ -113,6 +132,7 @@ class CSRFTokenTest(unittest.TestCase):
 
 class CollectionUtilTest(unittest.TestCase):
 
+    @classmethod
     def setUpClass(self):
         metadata.create_all(engine)
 
@@ -144,6 +164,7 @@ class CollectionUtilTest(unittest.TestCase):
 
         session.commit()
 
+    @classmethod
     def tearDownClass(self):
         session = Session()
         session.close()
@@ -153,6 +174,8 @@ class CollectionUtilTest(unittest.TestCase):
         self.assertEqual(1, to_collection(1))
         self.assertEqual(1.1, to_collection(1.1))
         self.assertEqual("str", to_collection("str"))
+        self.assertEqual([b"bytes", bytearray(b"bytearray")],
+                         to_collection([b"bytes", bytearray(b"bytearray")], recursive=True))
         self.assertEqual([1, 2, 3], to_collection([1, 2, 3]))
         self.assertEqual([1, 2, 3], to_collection((1, 2, 3)))
         self.assertEqual([1, 2, 3], to_collection(set([1, 2, 3])))
@@ -229,6 +252,360 @@ class CollectionUtilTest(unittest.TestCase):
         serialized_doc = '[{"combined": {"datetime": "2012-01-01T00:00:00"}, "date": {"date": "2012-01-01"}, "datetime": {"datetime": "2012-01-01T00:00:00"}, "discriminator": "derived", "geo": {"coordinates": [45.0, 45.0], "type": "Point"}, "related": [{"discriminator": "related", "id": 1, "key": "related1", "parent_id": 1}, {"discriminator": "relatedsubclass", "id": 2, "key": "related2", "parent_id": 1, "subclass_prop": "sub1"}], "time": {"time": "00:00:00"}}, {"date": {"date": "2013-02-02"}, "datetime": {"datetime": "2013-02-02T01:01:01"}, "discriminator": "base", "geo": {"coordinates": [46.0, 44.0], "type": "Point"}, "id": 2, "interval": {"interval": 3601}, "related": [{"discriminator": "related", "id": 3, "key": "related3", "parent_id": 2}, {"discriminator": "related", "id": 4, "key": "related4", "parent_id": 2}], "time": {"time": "01:01:01"}}]'
         self.assertEqual(serialized_doc, result)
 
+    def test_to_collection_limits(self):
+        root = Category(id=1)
+        child = Category(id=2, parent=root)
+
+        doc = {'id': 1,
+               'parent_id': None,
+               'parent': None,
+               'children': [{'id': 2,
+                             'parent_id': None,
+                             'parent': {'$ref': {'id': 1}},
+                             'children': []}]}
+        self.assertEqual(doc, to_collection(root, recursive=True))
+
+        doc = {'id': 1, 'parent_id': None, 'parent': None, 'children': [{'$ref': {'id': 2}}]}
+        self.assertEqual(doc, to_collection(root, recursive=True, max_depth=0))
+        self.assertRaises(ValueError, to_collection, root, recursive=True, max_nodes=1)
+
+        result = to_collection([child, root], recursive=True, references=True)
+        self.assertEqual([{'$ref': {'id': 2}}], result[0]['parent']['children'])
+        self.assertEqual({'$ref': {'id': 1}}, result[1])
+
+    def test_to_collection_cycle_without_backref(self):
+        CycleBase = declarative_base()
+
+        class Parent(CycleBase):
+            __tablename__ = 'parent'
+            id = Column(Integer, primary_key=True)
+            children = relationship('Child', backref='parent', foreign_keys='Child.parent_id')
+
+        class Child(CycleBase):
+            __tablename__ = 'child'
+            id = Column(Integer, primary_key=True)
+            parent_id = Column(Integer, ForeignKey('parent.id'))
+            owner_id = Column(Integer, ForeignKey('parent.id'))
+            owner = relationship(Parent, foreign_keys=[owner_id])
+
+        parent = Parent(id=1)
+        child = Child(id=2, parent=parent, owner=parent)
+
+        # the owner has no backref to exclude, so the cycle ends where an
+        # object is reached again on its own path
+        result = to_collection(parent, recursive=True)
+        self.assertEqual([{'$ref': {'id': 2}}], result['children'][0]['owner']['children'])
+
+        # the child is reached again once with the backref excluded, and then
+        # with the same spec
+        result = to_collection(child, recursive=True)
+        owner = result['owner']['children'][0]['owner']
+        self.assertEqual([{'$ref': {'id': 2}}], owner['children'])
+
+    def test_to_collection_references(self):
+        RefBase = declarative_base()
+
+        class Owner(RefBase):
+            __tablename__ = 'owner'
+            id = Column(Integer, primary_key=True)
+            top_item_id = Column(Integer, ForeignKey('item.id'))
+            items = relationship('Item', foreign_keys='Item.owner_id')
+            top_item = relationship('Item', foreign_keys=[top_item_id])
+
+        class Item(RefBase):
+            __tablename__ = 'item'
+            id = Column(Integer, primary_key=True)
+            owner_id = Column(Integer, ForeignKey('owner.id'))
+
+        item = Item(id=1)
+        owner = Owner(id=1, items=[item], top_item=item)
+        # the first occurrence in the order of the property names is converted,
+        # whether or not it is in a collection
+        doc = {'id': 1,
+               'items': [{'id': 1, 'owner_id': None}],
+               'top_item_id': None,
+               'top_item': {'$ref': {'id': 1}}}
+        self.assertEqual(doc, to_collection(owner, recursive=True, references=True))
+        self.assertEqual(doc, json.loads(to_collection(owner, format="json", recursive=True,
+                                                       references=True)))
+
+    def test_to_collection_json_encoder(self):
+        values = [date(2012, 1, 1), {"a": [time(1, 1, 1)]}, set([1])]
+        self.assertEqual('[{"date": "2012-01-01"}, {"a": [{"time": "01:01:01"}]}, [1]]',
+                         to_collection(values, format="json", recursive=True))
+        self.assertRaises(TypeError, to_collection, values, format="json")
+        self.assertEqual('[{"date": "2012-01-01"}, "object"]',
+                         to_collection([date(2012, 1, 1), object()], format="json",
+                                       recursive=True, default=lambda o: type(o).__name__))
+
+    def test_register_converter(self):
+        class Celsius(float):
+            pass
+
+        self.assertEqual([21.5], to_collection([Celsius(21.5)], recursive=True))
+
+        register_converter(float, lambda value: {"float": repr(value)})
+        try:
+            self.assertEqual([{"float": "21.5"}], to_collection([Celsius(21.5)], recursive=True))
+            self.assertEqual([21.5], to_collection([21.5], recursive=True))
+        finally:
+            util._converters[float] = util._identity
+            util._converter_cache.clear()
+
+        self.assertEqual([21.5], to_collection([Celsius(21.5)], recursive=True))
+
+    def test_includes_excludes(self):
+        session = Session()
+        te = session.query(TestEntity).get(2)
+        excludes = ["date", "time", "datetime", "interval", "geo", "discriminator"]
+
+        # excludes not keyed by class apply to the class of the first model
+        # object only
+        doc = {'related': [{'id': 3, 'key': u'related3', 'parent_id': 2,
+                            'discriminator': 'related'},
+                           {'id': 4, 'key': u'related4', 'parent_id': 2,
+                            'discriminator': 'related'}]}
+        self.assertEqual(doc, to_collection(te, recursive=True, excludes=excludes + ["id"]))
+
+        doc = {'id': 2, 'related': [{'id': 3, 'parent_id': 2}, {'id': 4, 'parent_id': 2}]}
+        self.assertEqual(doc, to_collection(te, recursive=True,
+                                            excludes={TestEntity: excludes,
+                                                      RelatedEntity: ["key", "discriminator"]}))
+
+        doc = {'id': 2, 'related': [{'id': 3, 'key': u'related3', 'parent_id': 2},
+                                    {'id': 4, 'key': u'related4', 'parent_id': 2}]}
+        self.assertEqual(doc, to_collection(te, recursive=True,
+                                            excludes={TestEntity: excludes,
+                                                      RelatedEntity: "discriminator"}))
+
+        self.assertRaises(TypeError, to_collection, te, includes=1)
+
+    def test_serialization_plan_cache(self):
+        LateBase = declarative_base()
+
+        class LateEntity(LateBase):
+            __tablename__ = 'lateentity'
+            id = Column(Integer, primary_key=True)
+
+        late = LateEntity(id=1)
+        self.assertEqual({'id': 1}, to_collection(late, recursive=True))
+        self.assertEqual({'id': 1}, to_collection(late, recursive=True))
+
+        # mapping a backref to a class adds a property to its plans
+        class LateChild(LateBase):
+            __tablename__ = 'latechild'
+            id = Column(Integer, primary_key=True)
+            parent_id = Column(Integer, ForeignKey('lateentity.id'))
+            parent = relationship(LateEntity, backref="children")
+
+        configure_mappers()
+        self.assertEqual({'id': 1, 'children': []}, to_collection(late, recursive=True))
+
+    def test_iter_json(self):
+        self.assertEqual("[]", "".join(iter_json([])))
+        self.assertEqual("[1, 2, 3]", "".join(iter_json([1, 2, 3], yield_per=2)))
+        self.assertEqual(['[{"date": "2012-01-01"}', ', {"date": "2013-02-02"}', ']'],
+                         list(iter_json([date(2012, 1, 1), date(2013, 2, 2)], yield_per=1)))
+
+        session = Session()
+        query = session.query(TestEntity).order_by(TestEntity.id)
+        kwargs = dict(recursive=True,
+                      includes={DerivedTestEntity: set(['combined'])},
+                      excludes={DerivedTestEntity: set(['id', 'interval', 'derivedprop'])},
+                      sort_keys=True)
+        self.assertEqual(to_collection(query.all(), format="json", **kwargs),
+                         "".join(iter_json(query, yield_per=1, **kwargs)))
+
+    def test_preload_relationships(self):
+        session = sessionmaker(engine)()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        for id in range(10, 20):
+            session.add(TestEntity(id=id, related=[RelatedEntity(key=u"related%d" % id)]))
+        session.flush()
+
+        query = session.query(RelatedEntity).with_polymorphic("*").order_by(RelatedEntity.id)
+        entities = query.all()
+        parents = set([re.parent_id for re in entities])
+        expected = to_collection(entities, recursive=True)
+        session.expunge_all()
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            entities = query.all()
+            del statements[:]
+            self.assertEqual(expected, to_collection(entities, recursive=True))
+            # lazy loading would take at least a query for each parent, batch
+            # loading takes a few for all of them
+            self.assertLess(len(statements), len(parents))
+
+            # with max_nodes, only the first parent is loaded before the walk
+            # gives up, instead of batches for all of them
+            session.expunge_all()
+            entities = query.all()
+            del statements[:]
+            self.assertRaises(ValueError, to_collection, entities, recursive=True, max_nodes=1)
+            self.assertLessEqual(len(statements), 1)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+            session.rollback()
+            session.close()
+
+    def test_preload_cycle_without_backref(self):
+        CycleBase = declarative_base()
+
+        class Parent(CycleBase):
+            __tablename__ = 'cycleparent'
+            id = Column(Integer, primary_key=True)
+            children = relationship('Child', backref='parent', foreign_keys='Child.parent_id')
+
+        class Child(CycleBase):
+            __tablename__ = 'cyclechild'
+            id = Column(Integer, primary_key=True)
+            parent_id = Column(Integer, ForeignKey('cycleparent.id'))
+            owner_id = Column(Integer, ForeignKey('cycleparent.id'))
+            owner = relationship(Parent, foreign_keys=[owner_id])
+
+        CycleBase.metadata.create_all(engine)
+        session = sessionmaker(engine)()
+        try:
+            parent = Parent(id=1)
+            session.add(Child(id=2, parent=parent, owner=parent))
+            session.commit()
+            session.expunge_all()
+
+            parent = session.query(Parent).get(1)
+            result = to_collection(parent, recursive=True)
+            self.assertEqual([{'$ref': {'id': 2}}], result['children'][0]['owner']['children'])
+            self.assertEqual(result, json.loads(to_collection(parent, format="json",
+                                                              recursive=True)))
+            self.assertEqual([result], json.loads("".join(iter_json([parent], recursive=True))))
+
+            result = to_collection(parent, recursive=True, references=True)
+            self.assertEqual({'$ref': {'id': 1}}, result['children'][0]['owner'])
+            self.assertRaises(ValueError, to_collection, parent, recursive=True, max_nodes=2)
+        finally:
+            session.close()
+            CycleBase.metadata.drop_all(engine)
+
+    def test_to_collection_rows(self):
+        session = Session()
+        row = session.query(TestEntity.id, TestEntity.date).filter_by(id=2).one()
+        self.assertEqual({'id': 2, 'date': {'date': '2013-02-02'}}, to_collection(row))
+
+        query = session.query(TestEntity.id, TestEntity.date).filter_by(id=2)
+        self.assertEqual([{'id': 2, 'date': {'date': '2013-02-02'}}], to_collection(query))
+        self.assertEqual([{'id': 2, 'date': {'date': '2013-02-02'}}], to_collection(query.all()))
+        self.assertEqual('[{"date": {"date": "2013-02-02"}, "id": 2}]',
+                         to_collection(query, format="json", sort_keys=True,
+                                       namedtuple_as_object=False))
+
+        row = session.query(RelatedEntity, RelatedEntity.parent_id).filter_by(id=3).one()
+        self.assertEqual({'RelatedEntity': {'id': 3,
+                                            'discriminator': 'related',
+                                            'key': u'related3',
+                                            'parent_id': 2},
+                          'parent_id': 2}, to_collection(row))
+
+        table = TestEntity.__table__
+        rows = session.execute(table.select()
+                               .with_only_columns([table.c.id, table.c.interval])
+                               .order_by(table.c.id)).fetchall()
+        self.assertEqual([{'id': 1, 'interval': {'interval': 3600}},
+                          {'id': 2, 'interval': {'interval': 3601}}],
+                         to_collection(rows, recursive=True))
+        self.assertEqual('[{"id": 1, "interval": {"interval": 3600}}, '
+                         '{"id": 2, "interval": {"interval": 3601}}]',
+                         "".join(iter_json(session.query(TestEntity.id, TestEntity.interval)
+                                           .order_by(TestEntity.id), sort_keys=True)))
+
+    def test_to_columns(self):
+        session = Session()
+        entities = (session.query(TestEntity).filter_by(discriminator="base")
+                    .order_by(TestEntity.id).all())
+
+        result = to_columns(entities, excludes=["geo"])
+        self.assertEqual(['date', 'datetime', 'discriminator', 'id', 'interval', 'time'],
+                         result["columns"])
+        self.assertEqual([[{'date': '2013-02-02'}, {'datetime': '2013-02-02T01:01:01'}, 'base',
+                           2, {'interval': 3601}, {'time': '01:01:01'}]], result["rows"])
+        self.assertEqual([to_collection(te, excludes=["geo"]) for te in entities],
+                         [dict(zip(result["columns"], row)) for row in result["rows"]])
+
+        excludes = {TestEntity: set(["date", "datetime", "discriminator", "interval", "time",
+                                     "geo"])}
+        self.assertEqual({"id": [2]}, to_columns(entities, excludes=excludes, layout="columns"))
+        self.assertEqual('{"id": [2]}', to_columns(session.query(TestEntity).filter_by(id=2),
+                                                   excludes=excludes, layout="columns",
+                                                   format="json"))
+        self.assertEqual({"columns": [], "rows": []}, to_columns([]))
+
+        self.assertRaises(ValueError, to_columns, session.query(TestEntity).all())
+        self.assertRaises(ValueError, to_columns, entities, layout="table")
+
+    def test_from_collection_batched_lookups(self):
+        session = sessionmaker(engine)()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            te = session.query(TestEntity).get(2)
+            del statements[:]
+            from_collection({"related": [{"id": 3, "key": u"related3a"},
+                                         {"id": 4, "key": u"related4a", "parent": {"id": 2}}]},
+                            te)
+            self.assertEqual([u"related3a", u"related4a"],
+                             sorted([related.key for related in te.related]))
+            selects = [statement for statement in statements
+                       if statement.startswith("SELECT") and "FROM related" in statement]
+            self.assertEqual(1, len([select for select in selects if "related.id IN" in select]))
+            self.assertFalse([select for select in selects if "related.id = " in select])
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+            session.rollback()
+            session.close()
+
+    def test_from_collection_merge(self):
+        session = sessionmaker(engine)()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            te = session.query(TestEntity).get(2)
+            related3, related4 = sorted(te.related, key=lambda related: related.id)
+            del statements[:]
+
+            from_collection({"related": [{"id": 3, "key": u"related3a"},
+                                         {"key": u"related5", "discriminator": "related"}]},
+                            te, collection_handling="merge")
+            self.assertFalse([statement for statement in statements
+                              if statement.startswith("SELECT")])
+            self.assertEqual([None, 3], sorted([related.id for related in te.related]))
+            self.assertIn(related3, te.related)
+            self.assertNotIn(related4, te.related)
+            self.assertEqual(u"related3a", related3.key)
+
+            session.flush()
+            inserts = [statement for statement in statements if statement.startswith("INSERT")]
+            self.assertEqual(1, len(inserts))
+            self.assertEqual([3, 5], sorted([related.id for related in te.related]))
+            self.assertIsNone(related4.parent_id)
+
+            self.assertRaises(ValueError, from_collection, {}, te, collection_handling="bogus")
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+            session.rollback()
+            session.close()
+
     def test_from_collection(self):
         self.assertEqual(1, from_collection(1, None))
         self.assertEqual(1.1, from_collection(1.1, None))
@@ -276,28 +653,33 @@ class CollectionUtilTest(unittest.TestCase):
                'geo': {'type': 'Point', 'coordinates': (45, 45)},
                'related': [{'key': u'key1', 'parent_id': 1, 'discriminator': u'related', "id": 3}]}
 
-        session = Session()
-        te = session.query(TestEntity).get(2)
-        te = from_collection(doc, te, excludes=["interval"])
-        self.assertEqual(te.date, date(2012, 1, 1))
-        self.assertEqual(te.time, time(0, 0, 0))
-        self.assertEqual(te.interval, timedelta(seconds=3601))
-        self.assertEqual(te.datetime, datetime(2012, 1, 1, 0, 0, 0))
-        self.assertEqual(te.id, 1)
-        self.assertEqual(to_shape(te.geo).wkt, Point(45, 45).wkt)
-        self.assertEqual(te.related[0].parent_id, 1)
-        self.assertEqual(te.related[0].key, u"key1")
-        self.assertEqual(te.related[0].id, 3)
-        self.assertEqual(te.related[0].discriminator, u"related")
-        self.assertEqual(len(te.related), 1)
-        self.assertIsNotNone(Session.object_session(te.related[0]))
-
-        doc = {'related': [{'key': u'hello', 'parent_id': 1, 'discriminator': u'related'}]}
-        te = from_collection(doc, te, collection_handling="append")
-        self.assertEqual(len(te.related), 2)
-        self.assertEqual(te.related[-1].key, u"hello")
-        self.assertEqual(te.related[-1].parent_id, 1)
-        self.assertEqual(te.related[-1].discriminator, "related")
+        # the changes are rolled back, as the other tests read the same rows
+        session = sessionmaker(engine)()
+        try:
+            te = session.query(TestEntity).get(2)
+            te = from_collection(doc, te, excludes=["interval"])
+            self.assertEqual(te.date, date(2012, 1, 1))
+            self.assertEqual(te.time, time(0, 0, 0))
+            self.assertEqual(te.interval, timedelta(seconds=3601))
+            self.assertEqual(te.datetime, datetime(2012, 1, 1, 0, 0, 0))
+            self.assertEqual(te.id, 1)
+            self.assertEqual(to_shape(te.geo).wkt, Point(45, 45).wkt)
+            self.assertEqual(te.related[0].parent_id, 1)
+            self.assertEqual(te.related[0].key, u"key1")
+            self.assertEqual(te.related[0].id, 3)
+            self.assertEqual(te.related[0].discriminator, u"related")
+            self.assertEqual(len(te.related), 1)
+            self.assertIsNotNone(Session.object_session(te.related[0]))
+
+            doc = {'related': [{'key': u'hello', 'parent_id': 1, 'discriminator': u'related'}]}
+            te = from_collection(doc, te, collection_handling="append")
+            self.assertEqual(len(te.related), 2)
+            self.assertEqual(te.related[-1].key, u"hello")
+            self.assertEqual(te.related[-1].parent_id, 1)
+            self.assertEqual(te.related[-1].discriminator, "related")
+        finally:
+            session.rollback()
+            session.close()
 
         te = DerivedTestEntity()
         json_doc = '{"time": {"time": "00:00:00"}, "date": {"date": "2012-01-01"}, "geo": {"type": "Point", "coordinates": [45, 45]}, "interval": {"interval": 3600}, "datetime": {"datetime": "2012-01-01T00:00:00"}, "id": 1, "related": [{"parent_id": 1, "key": "key1", "discriminator": "related"}, {"parent_id": 1, "subclass_prop": "sub", "key": "key2", "discriminator": "relatedsubclass"}], "derivedprop": 2}'
@@ -1,19 +1,103 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import collections
+import hashlib
+import heapq
 import logging
+import math
+import mimetypes
+import os.path
+import random
+import re
+import stat
+import tempfile
+import threading
+import time
+import uuid
 import warnings
+import zlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 import cherrypy
-from cherrypy._cptools import Tool, _getargs
+from cherrypy._cpcompat import unquote
+from cherrypy._cptools import HandlerTool, Tool, _getargs
+from cherrypy.lib import cptools, encoding, httputil, static
+from cherrypy.lib.httputil import valid_status
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc_support = False
+else:
+    tracemalloc_support = True
+
+try:
+    import brotli
+except ImportError:
+    brotli_support = False
+else:
+    brotli_support = True
 
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
+try:
+    from sqlalchemy import event, text
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from sqlalchemy.exc import (OperationalError, SQLAlchemyError,
+                                TimeoutError as PoolTimeoutError)
+    from sqlalchemy.pool import QueuePool
+except ImportError:
+    sqlalchemy_support = False
+else:
+    sqlalchemy_support = True
 
+from blueberrypy.circuit_breaker import CircuitBreaker
+from blueberrypy.exc import RetryAfterHTTPError
+from blueberrypy.util import iter_json
 
-__all__ = ["SQLAlchemySessionTool"]
+
+__all__ = ["SQLAlchemySessionTool", "RequestTimingTool", "LatencyHistogram",
+           "ResponseCacheTool", "MemoryResponseStorage", "RedisResponseStorage",
+           "CompressionTool", "RateLimitTool", "SingleFlightTool", "stream_json",
+           "StaticAssetTool", "MemoryProfileTool", "register_tools"]
 
 
 logger = logging.getLogger(__name__)
 
 
+_timer = getattr(time, "perf_counter", time.time)
+
+
+def _config_key(conf):
+    """Returns a key identifying the option values of a tool config, or None
+    if one of the values isn't hashable.
+
+    Lists, tuples, sets and dicts, such as the `bindings` list of
+    `SQLAlchemySessionTool`, are keyed by their contents. The type of each
+    value is part of the key, so values that compare equal, such as 1 and
+    True, don't share a key.
+    """
+    try:
+        return frozenset([(k, _config_value_key(v)) for k, v in conf.viewitems()])
+    except TypeError:
+        return None
+
+
+def _config_value_key(value):
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple([_config_value_key(v) for v in value])
+    elif isinstance(value, (set, frozenset)):
+        return type(value), frozenset([_config_value_key(v) for v in value])
+    elif isinstance(value, dict):
+        return type(value), frozenset([(k, _config_value_key(v)) for k, v in value.viewitems()])
+    return type(value), value
+
+
 class MultiHookPointTool(Tool):
     """MultiHookPointTool provides subclasses the infrastructure for writing
     Tools that need to run at more than one request hook point.
@@ -21,6 +105,11 @@ class MultiHookPointTool(Tool):
     Subclasses can simply provide methods with the same name as the hook points
     and MuiltiHookPointTool will automatically wire each hook up to the request
     hook points when turned on in the configuration.
+
+    The hook points a tool provides are found once on construction, and the
+    arguments and priorities of its hooks are computed once per distinct tool
+    configuration, so turning a tool on for a request only costs a few
+    `hooks.attach` calls.
     """
 
     def __init__(self, name=None, priority=50):
@@ -50,55 +139,269 @@ class MultiHookPointTool(Tool):
         """
         self._name = name
         self._priority = priority
+        self._hooks = self._find_hooks()
+        self._hook_plans = {}
         self._setargs()
 
-    def _setargs(self):
+    # Upper bound on the number of distinct tool configurations whose hook
+    # plans are cached
+    max_hook_plans = 1024
+
+    def _find_hooks(self):
+        hooks = []
         for hook_point in cherrypy._cprequest.hookpoints:
             if hasattr(self, hook_point):
                 hook = getattr(self, hook_point)
-                try:
-                    for arg in _getargs(hook):
-                        setattr(self, hook_point + "_" + arg, None)
-                # IronPython 1.0 raises NotImplementedError because
-                # inspect.getargspec tries to access Python bytecode
-                # in co_code attribute.
-                except NotImplementedError:
-                    pass
-                # IronPython 1B1 may raise IndexError in some cases,
-                # but if we trap it here it doesn't prevent CP from working.
-                except IndexError:
-                    pass
+                if not callable(hook):
+                    warnings.warn("%r is not a callable." % hook)
+                hooks.append((hook_point, hook))
+        return tuple(hooks)
 
-    def _setup(self):
+    def _setargs(self):
+        for hook_point, hook in self._hooks:
+            try:
+                for arg in _getargs(hook):
+                    setattr(self, hook_point + "_" + arg, None)
+            # IronPython 1.0 raises NotImplementedError because
+            # inspect.getargspec tries to access Python bytecode
+            # in co_code attribute.
+            except NotImplementedError:
+                pass
+            # IronPython 1B1 may raise IndexError in some cases,
+            # but if we trap it here it doesn't prevent CP from working.
+            except IndexError:
+                pass
 
-        request = cherrypy.request
+    def _compile_hook_plan(self, conf):
+        """Splits the merged tool config into the arguments and priority of
+        each hook this tool provides.
 
-        conf = self._merged_args()
+        Returns a tuple of `(hook_point, hook, priority, hook_conf)`.
+        """
+        hook_confs = dict([(hook_point, {}) for hook_point, _ in self._hooks])
+        for k, v in conf.viewitems():
+            hook_point, _, arg = k.partition(".")
+            if arg and hook_point in hook_confs:
+                hook_confs[hook_point][arg] = v
 
-        for hook_point in cherrypy._cprequest.hookpoints:
+        plan = []
+        for hook_point, hook in self._hooks:
+            hook_conf = hook_confs[hook_point]
+            # hooks without a priority of their own get the default of their
+            # callable, or 50
+            priority = hook_conf.pop("priority", None)
+            plan.append((hook_point, hook, priority, hook_conf))
+        return tuple(plan)
 
-            if hasattr(self, hook_point):
-                hook = getattr(self, hook_point)
-                if not callable(hook):
-                    warnings.warn("%r is not a callable." % hook)
+    def _setup(self):
+
+        conf = self._merged_args()
 
-                hook_conf = {}
-                for k, v in conf.viewitems():
-                    if k.startswith(hook_point):
-                        k = k.replace(hook_point, "").split(".", 1)[-1]
-                        hook_conf[k] = v
+        # The plan only depends on the tool config, so it's compiled once for
+        # each distinct config instead of once per request. Configs with
+        # unhashable values, and configs beyond the cache size, are compiled
+        # on every request.
+        key = _config_key(conf)
+        plan = self._hook_plans.get(key) if key is not None else None
+        if plan is None:
+            plan = self._compile_hook_plan(conf)
+            if key is not None and len(self._hook_plans) < self.max_hook_plans:
+                self._hook_plans[key] = plan
 
-                priority_key = hook_point + ".priority"
-                hook_priority = (self._priority
-                                 if priority_key not in hook_conf
-                                 else hook_conf[priority_key])
-                request.hooks.attach(hook_point, hook, hook_priority, **hook_conf)
+        attach = cherrypy.serving.request.hooks.attach
+        for hook_point, hook, priority, hook_conf in plan:
+            # Hooks are failsafe so cleanup hooks still run when another hook
+            # at the same point has failed.
+            attach(hook_point, hook, True, priority, **hook_conf)
 
     def __call__(self, *args, **kwargs):
         raise NotImplementedError("This %r instance cannot be called directly." %
                                   self.__class__.__name__)
 
 
+class _QueryProfile(object):
+    """Accumulates the statement count, total database time and the slowest
+    statements executed during a single request.
+    """
+
+    def __init__(self, slowest=3):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest = []
+        self._slowest_size = slowest
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        if self._slowest_size:
+            if len(self.slowest) < self._slowest_size:
+                heapq.heappush(self.slowest, (elapsed, statement))
+            else:
+                heapq.heappushpop(self.slowest, (elapsed, statement))
+
+    def as_dict(self):
+        return {"query_count": self.count,
+                "query_time": round(self.total_time * 1000, 3),
+                "slowest": [{"time": round(elapsed * 1000, 3), "statement": statement}
+                            for elapsed, statement in sorted(self.slowest, reverse=True)]}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(cherrypy.serving.request, "orm_profile", None) is not None:
+        context._blueberrypy_start_time = _timer()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = getattr(context, "_blueberrypy_start_time", None)
+    if start_time is not None:
+        profile = getattr(cherrypy.serving.request, "orm_profile", None)
+        if profile is not None:
+            profile.record(statement, _timer() - start_time)
+
+
+_instrument_lock = threading.Lock()
+
+
+SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "TRACE"])
+
+# Dialects understanding the standard SQL `SET TRANSACTION READ ONLY`
+_READ_ONLY_DIALECTS = frozenset(["mysql", "oracle", "postgresql"])
+
+
+def _set_transaction_read_only(session, transaction, connection):
+    if connection.dialect.name in _READ_ONLY_DIALECTS:
+        connection.execute(text("SET TRANSACTION READ ONLY"))
+
+
+def _instrument_engine(engine):
+    """Attaches the query profiling listeners to `engine` exactly once."""
+    if not event.contains(engine, "after_cursor_execute", _after_cursor_execute):
+        with _instrument_lock:
+            if not event.contains(engine, "after_cursor_execute", _after_cursor_execute):
+                event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _engine_circuit_breaker(engine, **kwargs):
+    """Returns the circuit breaker of `engine`, attaching the listeners that
+    report the outcome of its statements to the breaker the first time.
+
+    Disconnections and operational errors, such as statement timeouts, count
+    as failures, while errors such as integrity violations do not.
+    """
+    breaker = getattr(engine, "_blueberrypy_circuit_breaker", None)
+    if breaker is not None:
+        return breaker
+
+    with _instrument_lock:
+        breaker = getattr(engine, "_blueberrypy_circuit_breaker", None)
+        if breaker is None:
+            breaker = CircuitBreaker.get("sqlalchemy:%r" % (engine.url,), **kwargs)
+
+            def handle_error(context):
+                # is_disconnect is new in SQLAlchemy 1.0
+                disconnect = getattr(context, "is_disconnect", False)
+                if disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                    breaker.record_failure()
+
+            def after_cursor_execute(conn, cursor, statement, parameters, context,
+                                     executemany):
+                breaker.record_success()
+
+            event.listen(engine, "handle_error", handle_error)
+            event.listen(engine, "after_cursor_execute", after_cursor_execute)
+            engine._blueberrypy_circuit_breaker = breaker
+
+    return breaker
+
+
+class _ConnectionSlots(object):
+    """Counts the connections checked out of a pool with a fixed capacity, so
+    that a request can wait for one of them with a timeout.
+
+    The count is kept up to date by the pool's checkout and checkin events, so
+    connections checked out by anything else also take a slot. A request
+    reserves a slot before it checks out a connection, and the reservation
+    turns into the checkout once the pool hands the connection out.
+    """
+
+    def __init__(self, engine, capacity):
+        self.capacity = capacity
+        self._cond = threading.Condition(threading.Lock())
+        self._reservations = threading.local()
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "detach", self._on_checkin)
+        self.in_use = engine.pool.checkedout()
+
+    def reserve(self, deadline):
+        """Reserves a slot for the current thread. Returns False if no slot
+        comes free before `deadline`.
+        """
+        with self._cond:
+            while self.in_use >= self.capacity:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_use += 1
+            self._reservations.count = getattr(self._reservations, "count", 0) + 1
+            return True
+
+    def cancel(self):
+        """Gives back the reservations of the current thread that no checkout
+        has used.
+        """
+        count = getattr(self._reservations, "count", 0)
+        if count:
+            self._reservations.count = 0
+            with self._cond:
+                self.in_use -= count
+                self._cond.notify(count)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        count = getattr(self._reservations, "count", 0)
+        if count:
+            self._reservations.count = count - 1
+        else:
+            with self._cond:
+                self.in_use += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+
+def _engine_connection_slots(engine):
+    """Returns the connection slots of `engine`, or None if its pool never
+    blocks a checkout.
+
+    Only QueuePool limits the number of connections. Pools with an unlimited
+    overflow, NullPool and SingletonThreadPool hand out connections right away.
+    """
+    slots = getattr(engine, "_blueberrypy_connection_slots", None)
+    if slots is not None:
+        return slots
+
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return None
+
+    # the overflow limit is only exposed by the constructor argument
+    max_overflow = getattr(pool, "_max_overflow", -1)
+    if max_overflow < 0:
+        return None
+
+    with _instrument_lock:
+        slots = getattr(engine, "_blueberrypy_connection_slots", None)
+        if slots is None:
+            slots = engine._blueberrypy_connection_slots = _ConnectionSlots(
+                engine, pool.size() + max_overflow)
+
+    return slots
+
+
 class SQLAlchemySessionTool(MultiHookPointTool):
     """A CherryPy tool to process SQLAlchemy ORM sessions for requests.
 
@@ -113,9 +416,70 @@ class SQLAlchemySessionTool(MultiHookPointTool):
     accept 3 `priority` options - `on_start_resource.priority`,
     `before_finalize.priority` and `after_error_response.priority`. The `priority`
     option is still accepted as a default for all 3 hook points.
+
+    Query profiling can be turned on with `on_start_resource.profile`. When
+    on, the statement count and the total time spent in the database are
+    accumulated for the request and emitted in the `X-ORM-Query-Count` and
+    `X-ORM-Query-Time` (in milliseconds) response headers. A JSON log line
+    including the `on_start_resource.profile_slowest` slowest statements is
+    also written to this module's logger. Only a fraction of the requests,
+    given by `on_start_resource.profile_sample_rate`, is profiled so the
+    profiler can stay on under load.
+
+    The transaction boundaries can be managed by this tool by setting
+    `on_start_resource.transaction_policy` to `auto`. Under this policy,
+    requests with unsafe methods are committed once in `before_finalize` if the
+    response status is below 400, and requests with safe methods (GET, HEAD,
+    OPTIONS and TRACE) run in a read-only transaction which is never
+    committed. On databases that support it, `SET TRANSACTION READ ONLY` is
+    issued at the beginning of the transaction so the database can optimize
+    the read-only work. The default policy `manual` leaves committing to your
+    controllers.
+
+    To stop request threads from piling up waiting on an exhausted connection
+    pool, `on_start_resource.checkout_timeout` can be set to the number of
+    seconds a request is willing to wait for a connection. The connections
+    are then checked out when the request starts, and if they can't be
+    checked out in time, the request fails fast with a 503 response, with a
+    `Retry-After` header of `on_start_resource.retry_after` seconds. Like any
+    other tool option, the deadline can be set per path. The request waits for
+    a free connection slot of a `QueuePool` before it checks out, so the wait
+    is bounded by the deadline rather than the pool timeout. Only connections
+    checked out by other threads in the short time between the wait and the
+    checkout can still make the checkout block for the pool timeout.
+
+    If `on_start_resource.circuit_breaker` is true, each engine gets a
+    `blueberrypy.circuit_breaker.CircuitBreaker`. After
+    `on_start_resource.circuit_breaker_threshold` consecutive disconnections,
+    operational errors or connection checkout timeouts, requests fail fast
+    with a 503 response without touching the database for
+    `on_start_resource.circuit_breaker_cooldown` seconds, after which a single
+    request is let through to probe the database.
+
+    Example::
+
+        app_config = {
+            "/": {
+                "tools.orm_session.on": True,
+                "tools.orm_session.on_start_resource.checkout_timeout": 0.5,
+                "tools.orm_session.on_start_resource.transaction_policy": "auto",
+                "tools.orm_session.on_start_resource.profile": True,
+                "tools.orm_session.on_start_resource.profile_sample_rate": 0.01
+            }
+        }
     """
 
-    def on_start_resource(self, bindings=None):
+    def on_start_resource(self, bindings=None, profile=False, profile_sample_rate=1.0,
+                          profile_slowest=3, transaction_policy="manual",
+                          checkout_timeout=None, retry_after=1, circuit_breaker=False,
+                          circuit_breaker_threshold=5, circuit_breaker_cooldown=30):
+
+        if transaction_policy not in ("manual", "auto"):
+            raise ValueError("transaction_policy must be 'manual' or 'auto'.")
+
+        req = cherrypy.request
+        read_only = transaction_policy == "auto" and req.method in SAFE_METHODS
+
         if bindings:
 
             if len(bindings) > 1:
@@ -129,21 +493,114 @@ class SQLAlchemySessionTool(MultiHookPointTool):
                 session_bindings[binding] = engine_bindings[binding]
 
             Session.configure(binds=session_bindings)
+            engines = session_bindings.viewvalues()
 
         else:
             Session = scoped_session(sessionmaker())
-            Session.configure(bind=cherrypy.engine.sqlalchemy.engine)
+            engine = cherrypy.engine.sqlalchemy.engine
+            Session.configure(bind=engine)
+            engines = [engine]
+
+        if read_only:
+            event.listen(Session.session_factory, "after_begin", _set_transaction_read_only)
+
+        req.orm_session = Session
+        req.orm_autocommit = transaction_policy == "auto" and not read_only
+
+        if profile and random.random() < profile_sample_rate:
+            for engine in engines:
+                _instrument_engine(engine)
+            req.orm_profile = _QueryProfile(slowest=profile_slowest)
+
+        breakers = []
+        if circuit_breaker:
+            breakers = [_engine_circuit_breaker(engine,
+                                                failure_threshold=circuit_breaker_threshold,
+                                                cooldown=circuit_breaker_cooldown)
+                        for engine in engines]
+            for breaker in breakers:
+                breaker.before_call()
+
+        if checkout_timeout is not None:
+            self._checkout(Session, bindings, engines, checkout_timeout, retry_after, breakers)
 
-        cherrypy.request.orm_session = Session
+    def _checkout(self, Session, bindings, engines, timeout, retry_after, breakers=()):
+        deadline = time.time() + timeout
+
+        # a slot is reserved on each engine before anything is checked out, so
+        # the checkouts below find a free connection instead of blocking for
+        # the pool timeout
+        all_slots = []
+        for engine in set(engines):
+            slots = _engine_connection_slots(engine)
+            if slots is not None:
+                all_slots.append(slots)
+
+        try:
+            try:
+                for slots in all_slots:
+                    if not slots.reserve(deadline):
+                        raise PoolTimeoutError("No connection available within %ss" % timeout)
+
+                if bindings:
+                    for binding in bindings:
+                        Session.connection(mapper=binding)
+                else:
+                    Session.connection()
+            finally:
+                for slots in all_slots:
+                    slots.cancel()
+        except PoolTimeoutError as e:
+            logger.warning("Shedding %s %s: %s", cherrypy.request.method,
+                           cherrypy.request.path_info, e)
+            for breaker in breakers:
+                breaker.record_failure()
+            raise RetryAfterHTTPError(503, retry_after=retry_after)
 
     def before_finalize(self):
         req = cherrypy.request
         session = req.orm_session
-        session.remove()
+
+        if req.orm_autocommit and valid_status(cherrypy.response.status)[0] < 400:
+            try:
+                session.commit()
+            except SQLAlchemyError:
+                session.rollback()
+                session.remove()
+                raise
+
+        profile = getattr(req, "orm_profile", None)
+        if profile is not None:
+            self._report_profile(profile)
+
+        # streamed bodies may still lazily query the database, so the session
+        # is removed in on_end_request once the body has been sent
+        if not cherrypy.response.stream:
+            session.remove()
+
+    def on_end_request(self):
+        # on_start_resource may have failed before setting up the session
+        session = getattr(cherrypy.request, "orm_session", None)
+        if session is not None and cherrypy.response.stream:
+            session.remove()
+
+    def _report_profile(self, profile):
+        req = cherrypy.request
+        resp = cherrypy.response
+
+        report = profile.as_dict()
+        resp.headers["X-ORM-Query-Count"] = str(report["query_count"])
+        resp.headers["X-ORM-Query-Time"] = "%.3f" % report["query_time"]
+
+        report["method"] = req.method
+        report["path"] = req.path_info
+        logger.info(json.dumps(report, sort_keys=True))
 
     def after_error_response(self):
         req = cherrypy.request
-        session = req.orm_session
+        session = getattr(req, "orm_session", None)
+        if session is None:
+            return
 
         try:
             session.rollback()
@@ -153,3 +610,1290 @@ class SQLAlchemySessionTool(MultiHookPointTool):
             cherrypy.log.error(msg=e, severity=logging.ERROR, traceback=True)
         finally:
             session.remove()
+
+
+class LatencyHistogram(object):
+    """A thread-safe cumulative histogram of latencies in milliseconds."""
+
+    buckets = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        """Returns the count, the sum and the cumulative bucket counts as a
+        list of `(upper_bound, count)` tuples.
+        """
+        with self._lock:
+            cumulative, buckets = 0, []
+            for upper_bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets.append((upper_bound, cumulative))
+            return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class RequestTimingTool(MultiHookPointTool):
+    """A CherryPy tool that breaks the latency of requests down into phases.
+
+    This tool timestamps the request as it reaches each hook point, and
+    computes the time spent in the following phases in milliseconds:
+
+    ======== ============================================ =====================
+    phase    from                                         to
+    ======== ============================================ =====================
+    start    on_start_resource                            before_request_body
+    body     before_request_body                          before_handler
+    handler  before_handler                               before_finalize
+    finalize before_finalize                              on_end_request
+    total    on_start_resource                            on_end_request
+    ======== ============================================ =====================
+
+    `body` is the time spent reading and parsing the request body. `handler`
+    includes the tools running before the handler, such as sessions, as well
+    as the handler itself and any templating it does. The phases completed
+    before the response is finalized are sent in a `Server-Timing` header,
+    unless `before_finalize.header` is False. All the phases are aggregated
+    into the in-process `LatencyHistogram`s found in `histograms`.
+
+    The hooks of this tool run with priority 10 by default, so they run
+    before most other hooks at each hook point.
+
+    Example::
+
+        cherrypy.tools.request_timing = RequestTimingTool()
+
+        app_config = {
+            "/": {
+                "tools.request_timing.on": True
+            }
+        }
+    """
+
+    phases = (("start", "on_start_resource", "before_request_body"),
+              ("body", "before_request_body", "before_handler"),
+              ("handler", "before_handler", "before_finalize"),
+              ("finalize", "before_finalize", "on_end_request"),
+              ("total", "on_start_resource", "on_end_request"))
+
+    def __init__(self, name=None, priority=10):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+        self.histograms = dict([(phase, LatencyHistogram()) for phase, _, _ in self.phases])
+
+    def _timestamp(self, hook_point):
+        cherrypy.request.timings[hook_point] = _timer()
+
+    def _phase_durations(self, timings):
+        durations = []
+        for phase, start, end in self.phases:
+            if start in timings and end in timings:
+                durations.append((phase, (timings[end] - timings[start]) * 1000))
+        return durations
+
+    def on_start_resource(self):
+        cherrypy.request.timings = {"on_start_resource": _timer()}
+
+    def before_request_body(self):
+        self._timestamp("before_request_body")
+
+    def before_handler(self):
+        self._timestamp("before_handler")
+
+    def before_finalize(self, header=True):
+        self._timestamp("before_finalize")
+        if header:
+            durations = self._phase_durations(cherrypy.request.timings)
+            cherrypy.response.headers["Server-Timing"] = ", ".join(
+                ["%s;dur=%.3f" % (phase, duration) for phase, duration in durations])
+
+    def on_end_request(self):
+        timings = getattr(cherrypy.request, "timings", None)
+        if timings is None:
+            return
+
+        timings["on_end_request"] = _timer()
+        for phase, duration in self._phase_durations(timings):
+            self.histograms[phase].observe(duration)
+
+    def snapshot(self):
+        """Returns a mapping of phase names to their histogram snapshots."""
+        return dict([(phase, histogram.snapshot())
+                     for phase, histogram in self.histograms.viewitems()])
+
+
+# request headers carrying the identity of the user, which responses depend on
+# unless they are shared by every user
+_CREDENTIAL_HEADERS = ("Authorization", "Cookie")
+
+
+def _request_key(vary=None, shared=False):
+    """Returns a key identifying the resource requested by the current request
+    and the values of its `vary` request headers. Unless `shared` is true, the
+    credentials of the request are part of the key too, so one user never gets
+    the response rendered for another.
+    """
+    req = cherrypy.request
+    parts = [req.base, req.script_name, req.path_info, req.query_string]
+    headers = list(vary or ())
+    if not shared:
+        headers.extend(_CREDENTIAL_HEADERS)
+    for header in headers:
+        parts.append(header.lower() + ":" + req.headers.get(header, ""))
+    key = u"\n".join([part if isinstance(part, unicode) else part.decode("utf-8")
+                      for part in parts])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _etag_matches(etag):
+    # If-None-Match uses the weak comparison function
+    conditions = [str(x) for x in cherrypy.request.headers.elements("If-None-Match") or []]
+    if conditions == ["*"]:
+        return True
+    etag = etag[2:] if etag.startswith("W/") else etag
+    return etag in [c[2:] if c.startswith("W/") else c for c in conditions]
+
+
+def _redis_client(redis_kwargs):
+    """Returns the Redis connection set up for the `RedisSession` if there is one
+    and no `redis_kwargs` are given, otherwise a new client.
+    """
+    from blueberrypy.session import RedisSession
+    if hasattr(RedisSession, "cache") and not redis_kwargs:
+        return RedisSession.cache
+    from redis import StrictRedis
+    return StrictRedis(**redis_kwargs)
+
+
+class MemoryResponseStorage(object):
+    """An in-process LRU storage of at most `maxsize` cached responses."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, tags, entry = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                self._untag(key, tags)
+                return None
+
+            self._entries[key] = (expires, tags, entry)
+            return entry
+
+    def set(self, key, entry, ttl, tags=()):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._untag(key, old[1])
+
+            tags = frozenset(tags)
+            self._entries[key] = (time.time() + ttl, tags, entry)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                evicted_key, (_, evicted_tags, _) = self._entries.popitem(last=False)
+                self._untag(evicted_key, evicted_tags)
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    old = self._entries.pop(key, None)
+                    if old is not None:
+                        self._untag(key, old[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisResponseStorage(object):
+    """A Redis storage of cached responses shared by all processes.
+
+    If `client` is not given, the Redis connection set up for the `RedisSession`
+    is reused if there is one, otherwise a new client is created from
+    `redis_kwargs`.
+    """
+
+    def __init__(self, client=None, prefix="cp-response:", **redis_kwargs):
+        self.prefix = prefix
+        self._client = client
+        self._redis_kwargs = redis_kwargs
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = _redis_client(self._redis_kwargs)
+        return self._client
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        if data:
+            return pickle.loads(data)
+
+    def set(self, key, entry, ttl, tags=()):
+        ttl = max(int(ttl), 1)
+        pipe = self.client.pipeline()
+        pipe.setex(self.prefix + key, ttl, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        for tag in tags:
+            tag_key = self.prefix + "tag:" + tag
+            pipe.sadd(tag_key, key)
+            pipe.expire(tag_key, ttl)
+        pipe.execute()
+
+    def invalidate_tags(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + "tag:" + tag
+            keys = self.client.smembers(tag_key)
+            pipe = self.client.pipeline()
+            for key in keys:
+                if isinstance(key, bytes) and not isinstance(key, str):
+                    key = key.decode("utf-8")
+                pipe.delete(self.prefix + key)
+            pipe.delete(tag_key)
+            pipe.execute()
+
+    def clear(self):
+        keys = self.client.keys(self.prefix + "*")
+        if keys:
+            self.client.delete(*keys)
+
+
+class ResponseCacheTool(MultiHookPointTool):
+    """A CherryPy tool that caches rendered GET responses.
+
+    Responses are keyed by their URL, including the query string, the values
+    of the request headers listed in `before_handler.vary`, and the
+    `Authorization` and `Cookie` headers, so responses are only reused for the
+    same user. Set `before_handler.shared` to true for responses which are the
+    same for every user to leave the credentials out of the key. Successful
+    responses are stored for `before_handler.ttl` seconds with a strong `ETag`
+    computed from the body. When a cached response is found in
+    `before_handler`, it is served without invoking the controller. Requests
+    with a matching `If-None-Match` header are answered with 304, whether the
+    response was cached or has just been rendered.
+
+    Responses are kept in `storage`, which is a `MemoryResponseStorage` unless
+    another storage, such as a `RedisResponseStorage`, is given.
+
+    Handlers can tag the response being rendered with `tag()`, and invalidate
+    all the cached responses with some tags with `invalidate()`::
+
+        class Users(object):
+
+            @cherrypy.expose
+            def show(self, id):
+                cherrypy.tools.response_cache.tag("user:" + id)
+                ...
+
+            @cherrypy.expose
+            def update(self, id, **kwargs):
+                ...
+                cherrypy.tools.response_cache.invalidate("user:" + id)
+
+    Example::
+
+        cherrypy.tools.response_cache = ResponseCacheTool(RedisResponseStorage())
+
+        app_config = {
+            "/users": {
+                "tools.response_cache.on": True,
+                "tools.response_cache.before_handler.ttl": 60,
+                "tools.response_cache.before_handler.vary": ["Accept-Language"]
+            }
+        }
+    """
+
+    # per-request headers which are never cached
+    uncached_headers = frozenset(["Content-Length", "Date", "Server-Timing", "Set-Cookie"])
+
+    def __init__(self, storage=None, name=None, priority=50):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+        self.storage = storage if storage is not None else MemoryResponseStorage()
+
+    def before_handler(self, ttl=300, vary=None, shared=False):
+        req = cherrypy.request
+        if req.method not in ("GET", "HEAD"):
+            return
+
+        resp = cherrypy.response
+        if vary:
+            resp.headers["Vary"] = ", ".join(vary)
+
+        key = _request_key(vary, shared)
+        entry = self.storage.get(key)
+        if entry is None:
+            if req.method == "GET":
+                req.response_cache_key = key
+                req.response_cache_ttl = ttl
+            return
+
+        req.handler = None
+        for k, v in entry["headers"]:
+            resp.headers[k] = v
+        resp.headers["ETag"] = entry["etag"]
+
+        if _etag_matches(entry["etag"]):
+            raise cherrypy.HTTPRedirect([], 304)
+
+        resp.status = entry["status"]
+        resp.body = entry["body"]
+
+    def before_finalize(self):
+        req = cherrypy.request
+        resp = cherrypy.response
+
+        key = getattr(req, "response_cache_key", None)
+        if key is None or resp.stream or valid_status(resp.status)[0] != 200:
+            return
+
+        body = resp.collapse_body()
+        if isinstance(body, unicode):
+            body = resp.body = body.encode("utf-8")
+
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        resp.headers["ETag"] = etag
+
+        entry = {"status": resp.status,
+                 "headers": [(k, v) for k, v in resp.headers.items()
+                             if k not in self.uncached_headers],
+                 "body": body,
+                 "etag": etag}
+        self.storage.set(key, entry, req.response_cache_ttl, getattr(req, "cache_tags", ()))
+
+        if _etag_matches(etag):
+            raise cherrypy.HTTPRedirect([], 304)
+
+    def tag(self, *tags):
+        """Tags the response of the current request with `tags`."""
+        req = cherrypy.request
+        req.cache_tags = getattr(req, "cache_tags", ()) + tags
+
+    def invalidate(self, *tags):
+        """Removes all the cached responses tagged with any of `tags`."""
+        self.storage.invalidate_tags(tags)
+
+
+def _deflate(body, compress_level):
+    zobj = zlib.compressobj(compress_level)
+    for chunk in body:
+        yield zobj.compress(chunk)
+    yield zobj.flush()
+
+
+def _brotli(body, compress_level):
+    compressor = brotli.Compressor(quality=compress_level)
+    for chunk in body:
+        yield compressor.process(chunk)
+    yield compressor.finish()
+
+
+def _staticfile_path(filename, root=None):
+    if filename and not os.path.isabs(filename) and root:
+        filename = os.path.join(root, filename)
+    return filename
+
+
+def _staticdir_path(section, dir, root=None):
+    """Returns the path of the file in `dir` the staticdir tool configured on
+    `section` would serve for the current request, or None if there is none.
+    """
+    directory = os.path.expanduser(dir)
+    if not os.path.isabs(directory):
+        if not root:
+            return None
+        directory = os.path.join(root, directory)
+
+    if section == "global":
+        section = "/"
+    section = section.rstrip("\\/")
+    branch = unquote(cherrypy.request.path_info[len(section) + 1:].lstrip("\\/"))
+    filename = os.path.normpath(os.path.join(directory, branch))
+    if filename.startswith(os.path.normpath(directory)):
+        return filename
+
+
+# the names of the tools serving a single file and the tools serving a
+# directory, CherryPy's own and the StaticAssetTool ones
+_STATICFILE_TOOLS = ("staticfile", "static_asset_file")
+_STATICDIR_TOOLS = ("staticdir", "static_asset_dir")
+
+
+def _static_filename():
+    """Returns the path of the file the static file tools would serve for the
+    current request, or None if the request is not for a static file.
+    """
+    conf = cherrypy.request.config
+
+    for name in _STATICFILE_TOOLS:
+        prefix = "tools." + name + "."
+        if conf.get(prefix + "on"):
+            return _staticfile_path(conf.get(prefix + "filename"), conf.get(prefix + "root"))
+
+    for name in _STATICDIR_TOOLS:
+        prefix = "tools." + name + "."
+        if conf.get(prefix + "on"):
+            return _staticdir_path(conf.get(prefix + "section", "/"),
+                                   conf.get(prefix + "dir", ""),
+                                   conf.get(prefix + "root"))
+
+
+class CompressionTool(MultiHookPointTool):
+    """A CherryPy tool that compresses responses with the best content coding
+    accepted by the client among `br` (if the `brotli` package is installed),
+    `gzip` and `deflate`.
+
+    Dynamic responses are compressed while they are being streamed, so
+    compression does not require collapsing the response body first.
+
+    For files served by the `staticdir` and `staticfile` tools, or their
+    `StaticAssetTool` counterparts `static_asset_dir` and `static_asset_file`,
+    a precompressed `.gz` sibling is served instead when the client accepts
+    gzip and the sibling is not older than the file itself. `blueberrypy bundle --build`
+    generates these siblings, so static assets do not cost any compression CPU
+    per request.
+
+    Example::
+
+        app_config = {
+            "/": {
+                "tools.compress.on": True,
+                "tools.compress.before_finalize.level": 6,
+                "tools.compress.before_finalize.min_size": 512
+            }
+        }
+    """
+
+    codings = (("br", _brotli), ("gzip", encoding.compress),
+               ("x-gzip", encoding.compress), ("deflate", _deflate))
+    if not brotli_support:
+        codings = codings[1:]
+
+    mime_types = ("text/*", "application/javascript", "application/json",
+                  "application/xml", "application/*+json", "application/*+xml",
+                  "image/svg+xml")
+
+    # brotli qualities go from 0 to 11, zlib levels from 0 to 9
+    brotli_levels = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 5, 7: 6, 8: 8, 9: 11}
+
+    def __init__(self, name=None, priority=80):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+
+    def before_finalize(self, level=5, mime_types=None, min_size=256, precompressed=True):
+        req = cherrypy.serving.request
+        resp = cherrypy.serving.response
+
+        if req.method == "HEAD" or not resp.body or "Content-Encoding" in resp.headers:
+            return
+        if valid_status(resp.status)[0] != 200:
+            return
+
+        content_type = resp.headers.get("Content-Type", "").split(";", 1)[0].strip()
+        if not self._compressible(content_type, mime_types or self.mime_types):
+            return
+
+        encoding.set_vary_header(resp, "Accept-Encoding")
+
+        coding = self._negotiate()
+        if coding is None:
+            return
+
+        content_length = resp.headers.get("Content-Length")
+        if content_length is None and isinstance(resp.body, list):
+            content_length = sum([len(chunk) for chunk in resp.body])
+        if content_length is not None and int(content_length) < min_size:
+            return
+
+        if precompressed and req.handler is None and self._accepts("gzip"):
+            filename = _static_filename()
+            if filename and self._serve_precompressed(filename, content_type):
+                return
+
+        compress = dict(self.codings)[coding]
+        if compress is _brotli:
+            level = self.brotli_levels.get(level, level)
+
+        resp.body = compress(resp.body, level)
+        resp.headers["Content-Encoding"] = coding
+        resp.headers.pop("Content-Length", None)
+        self._weaken_etag()
+
+    def _negotiate(self):
+        accepted = cherrypy.serving.request.headers.elements("Accept-Encoding")
+        for element in accepted:
+            if element.qvalue == 0:
+                continue
+            if element.value == "identity":
+                return None
+            if element.value == "*":
+                return self.codings[0][0]
+            for coding, _ in self.codings:
+                if element.value == coding:
+                    return coding
+
+    def _accepts(self, coding):
+        for element in cherrypy.serving.request.headers.elements("Accept-Encoding"):
+            if element.value in (coding, "x-" + coding, "*"):
+                return element.qvalue > 0
+        return False
+
+    def _compressible(self, content_type, mime_types):
+        major, _, minor = content_type.partition("/")
+        for mime_type in mime_types:
+            if mime_type == content_type or mime_type == major + "/*":
+                return True
+            if "/*+" in mime_type:
+                mime_major, _, suffix = mime_type.partition("/*")
+                if mime_major == major and minor.endswith(suffix):
+                    return True
+        return False
+
+    def _serve_precompressed(self, filename, content_type):
+        gzipped = filename + ".gz"
+        try:
+            if os.stat(gzipped).st_mtime < os.stat(filename).st_mtime:
+                return False
+        except OSError:
+            return False
+
+        resp = cherrypy.serving.response
+        fileobj = getattr(resp.body, "input", None)
+        if hasattr(fileobj, "close"):
+            fileobj.close()
+
+        static.serve_file(gzipped, content_type=content_type)
+        resp.headers["Content-Encoding"] = "gzip"
+        self._weaken_etag()
+        return True
+
+    def _weaken_etag(self):
+        headers = cherrypy.serving.response.headers
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+
+
+class _TokenBucket(object):
+
+    __slots__ = ("capacity", "rate", "tokens", "updated", "pending", "blocked_until")
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = now
+        self.pending = 0
+        self.blocked_until = 0
+
+    def consume(self, now):
+        """Takes a token from the bucket. Returns 0 if there was one, otherwise
+        the number of seconds until there will be one.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+
+        self.tokens -= 1
+        self.pending += 1
+        return 0
+
+
+class RateLimitTool(MultiHookPointTool):
+    """A CherryPy tool that rate limits requests per client and per route.
+
+    Each client is allowed `limit` requests every `period` seconds, with bursts
+    of at most `burst` requests, by an in-process token bucket, so enforcing
+    the limit does not require any I/O. Clients are identified by their IP
+    address, or by the return value of the callable `key` if one is given.
+    If `per_route` is false, a client's requests to all the routes the tool is
+    enabled on count towards the same limit. Requests over the limit are
+    answered with 429 and a `Retry-After` header.
+
+    If `redis` is true, the requests taken from every local bucket are also
+    added to a counter in Redis once every `sync_batch` requests, so the limit
+    is enforced across processes. A process stops accepting requests from a
+    client until the end of the current period when the counter shows that the
+    client has reached the limit. Since requests are synced in batches, each
+    process may accept up to `sync_batch - 1` requests over the limit.
+
+    The Redis connection of the `RedisSession` is reused unless `redis_kwargs`
+    are given. If Redis is unavailable, only the local limits are enforced.
+
+    Example::
+
+        cherrypy.tools.rate_limit = RateLimitTool(redis=True)
+
+        app_config = {
+            "/api": {
+                "tools.rate_limit.on": True,
+                "tools.rate_limit.on_start_resource.limit": 100,
+                "tools.rate_limit.on_start_resource.period": 60
+            }
+        }
+    """
+
+    max_buckets = 10000
+
+    def __init__(self, redis=False, prefix="cp-ratelimit:", name=None, priority=20,
+                 **redis_kwargs):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+        self.redis = redis
+        self.prefix = prefix
+        self.buckets = {}
+        self._redis_kwargs = redis_kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = _redis_client(self._redis_kwargs)
+        return self._client
+
+    def on_start_resource(self, limit=60, period=60, burst=None, key=None, per_route=True,
+                          sync_batch=10):
+        req = cherrypy.serving.request
+
+        client = key() if key is not None else req.remote.ip
+        route = req.script_name + req.path_info if per_route else ""
+        bucket_key = (client, route, limit, period)
+
+        now = time.time()
+        with self._lock:
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self._prune(now)
+                capacity = burst if burst is not None else limit
+                bucket = self.buckets[bucket_key] = _TokenBucket(capacity, float(limit) / period,
+                                                                 now)
+            wait = bucket.consume(now)
+
+            pending = 0
+            if self.redis and bucket.pending >= sync_batch:
+                pending, bucket.pending = bucket.pending, 0
+
+        if pending and self._sync(bucket, client, route, limit, period, pending, now) > limit:
+            wait = bucket.blocked_until - now
+
+        if wait:
+            raise RetryAfterHTTPError(429, retry_after=int(math.ceil(wait)))
+
+    def _sync(self, bucket, client, route, limit, period, pending, now):
+        window = int(now // period)
+        counter_key = "%s%s:%s:%d" % (self.prefix, client, route, window)
+        try:
+            pipe = self.client.pipeline()
+            pipe.incrby(counter_key, pending)
+            pipe.expire(counter_key, int(period) + 1)
+            count = pipe.execute()[0]
+        except Exception:
+            logger.warning("Unable to sync rate limit counter %r with Redis.", counter_key,
+                           exc_info=True)
+            return 0
+
+        if count >= limit:
+            with self._lock:
+                bucket.blocked_until = (window + 1) * period
+        return count
+
+    def _prune(self, now):
+        for bucket_key, bucket in self.buckets.items():
+            tokens = bucket.tokens + (now - bucket.updated) * bucket.rate
+            if now >= bucket.blocked_until and tokens >= bucket.capacity:
+                del self.buckets[bucket_key]
+
+
+class _Flight(object):
+
+    __slots__ = ("event", "response")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class SingleFlightTool(MultiHookPointTool):
+    """A CherryPy tool that coalesces identical concurrent GET requests.
+
+    Requests are identical if they are for the same URL, including the query
+    string, and have the same values for the request headers listed in
+    `before_handler.vary`. The first of them becomes the leader and invokes the
+    handler, while the others wait up to `before_handler.timeout` seconds for
+    the leader's response and are answered with a copy of it. If the leader
+    fails or times out, the followers invoke the handler themselves. Only
+    successful, non-streaming responses are shared, without their cookies.
+
+    If `redis` is true, the leaders of different processes also take a lock in
+    Redis. The leader which does not get the lock polls Redis every
+    `before_handler.poll_interval` seconds for the response of the one which
+    did, which keeps it for `before_handler.result_ttl` seconds.
+
+    The Redis connection of the `RedisSession` is reused unless `redis_kwargs`
+    are given. If Redis is unavailable, requests are only coalesced within each
+    process.
+
+    Like the `ResponseCacheTool`, requests are only coalesced with requests
+    with the same `Authorization` and `Cookie` headers, unless
+    `before_handler.shared` is true.
+
+    This tool runs after the `ResponseCacheTool` with their default priorities,
+    so only the requests missing the response cache are coalesced.
+
+    Example::
+
+        app_config = {
+            "/popular": {
+                "tools.single_flight.on": True,
+                "tools.single_flight.before_handler.timeout": 5
+            }
+        }
+    """
+
+    def __init__(self, redis=False, prefix="cp-singleflight:", name=None, priority=60,
+                 **redis_kwargs):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+        self.redis = redis
+        self.prefix = prefix
+        self._redis_kwargs = redis_kwargs
+        self._client = None
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = _redis_client(self._redis_kwargs)
+        return self._client
+
+    def before_handler(self, vary=None, timeout=10, poll_interval=0.05, result_ttl=5,
+                       shared=False):
+        req = cherrypy.serving.request
+        if req.method not in ("GET", "HEAD"):
+            return
+
+        key = _request_key(vary, shared)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait(timeout)
+            if flight.response is not None:
+                self._respond(flight.response)
+            return
+
+        req.single_flight = (key, flight, None, result_ttl)
+
+        if self.redis:
+            token = uuid.uuid4().hex
+            try:
+                if self.client.set(self.prefix + "lock:" + key, token, nx=True,
+                                   px=int(timeout * 1000)):
+                    req.single_flight = (key, flight, token, result_ttl)
+                    return
+                response = self._wait_for_remote(key, timeout, poll_interval)
+            except Exception:
+                logger.warning("Unable to coalesce request %r with Redis.", key, exc_info=True)
+                return
+
+            if response is not None:
+                self._land(response)
+                self._respond(response)
+
+    def before_finalize(self):
+        if getattr(cherrypy.serving.request, "single_flight", None) is None:
+            return
+
+        resp = cherrypy.serving.response
+        response = None
+        if not resp.stream and valid_status(resp.status)[0] == 200:
+            body = resp.collapse_body()
+            if isinstance(body, unicode):
+                body = resp.body = body.encode("utf-8")
+            response = (resp.status,
+                        [(k, v) for k, v in resp.headers.items()
+                         if k not in ResponseCacheTool.uncached_headers],
+                        body)
+        self._land(response)
+
+    def on_end_request(self):
+        # the request failed before reaching before_finalize
+        if getattr(cherrypy.serving.request, "single_flight", None) is not None:
+            self._land(None)
+
+    def _wait_for_remote(self, key, timeout, poll_interval):
+        lock_key = self.prefix + "lock:" + key
+        result_key = self.prefix + "result:" + key
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data = self.client.get(result_key)
+            if data:
+                return pickle.loads(data)
+            if not self.client.exists(lock_key):
+                return None
+            time.sleep(poll_interval)
+
+    def _land(self, response):
+        """Hands `response` over to the followers of the current request."""
+        req = cherrypy.serving.request
+        key, flight, token, result_ttl = req.single_flight
+        req.single_flight = None
+
+        flight.response = response
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.event.set()
+
+        if token is not None:
+            lock_key = self.prefix + "lock:" + key
+            try:
+                if response is not None:
+                    self.client.setex(self.prefix + "result:" + key, result_ttl,
+                                      pickle.dumps(response, pickle.HIGHEST_PROTOCOL))
+                if self.client.get(lock_key) in (token, token.encode("ascii")):
+                    self.client.delete(lock_key)
+            except Exception:
+                logger.warning("Unable to release single flight lock %r.", lock_key,
+                               exc_info=True)
+
+    def _respond(self, response):
+        status, headers, body = response
+        resp = cherrypy.serving.response
+        cherrypy.serving.request.handler = None
+        resp.status = status
+        for k, v in headers:
+            resp.headers[k] = v
+        resp.body = body
+
+
+def _encode_chunks(chunks, encoding):
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(encoding)
+        yield chunk
+
+
+def stream_json(yield_per=100, recursive=False, includes=None, excludes=None,
+                content_type="application/json", **json_kwargs):
+    """A `before_handler` tool callable that streams the iterable, usually a
+    SQLAlchemy query, returned by the handler as a JSON array.
+
+    The body is produced by `blueberrypy.util.iter_json()` while it is being
+    sent, so large results are never held in memory as a whole. `yield_per`,
+    `recursive`, `includes`, `excludes` and `json_kwargs` are passed to
+    `iter_json()`. When used with the `SQLAlchemySessionTool`, the ORM session
+    stays open until the whole body has been sent.
+
+    Example::
+
+        cherrypy.tools.stream_json = cherrypy.Tool("before_handler", stream_json, priority=30)
+
+        class Users(object):
+
+            @cherrypy.expose
+            @cherrypy.tools.stream_json(yield_per=500)
+            def index(self):
+                return cherrypy.request.orm_session.query(User)
+    """
+
+    req = cherrypy.serving.request
+    handler = req.handler
+
+    def stream_json_handler(*args, **kwargs):
+        result = handler(*args, **kwargs)
+        resp = cherrypy.serving.response
+        resp.headers["Content-Type"] = content_type
+        resp.stream = True
+        return _encode_chunks(iter_json(result, includes=includes, excludes=excludes,
+                                        recursive=recursive, yield_per=yield_per,
+                                        **json_kwargs),
+                              "utf-8")
+
+    req.handler = stream_json_handler
+
+
+class _FileCache(object):
+    """A thread-safe LRU cache of the contents of at most `max_size` bytes of
+    files, each no larger than `max_file_size` bytes.
+    """
+
+    def __init__(self, max_size, max_file_size):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st):
+        """Returns the contents of the file at `path` whose `os.stat()` result
+        is `st`, reading the file if it is not cached or has been modified.
+        """
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == st.st_mtime and len(entry[1]) == st.st_size:
+                    self._entries[path] = entry
+                    return entry[1]
+                self.size -= len(entry[1])
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[path] = (st.st_mtime, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class StaticAssetTool(HandlerTool):
+    """A counterpart of CherryPy's `staticdir` and `staticfile` tools which sets
+    caching headers suitable for webassets bundles and serves small files from
+    memory. It takes the same options as the tool it wraps.
+
+    Files with a fingerprint in their names, like `packed.1a2b3c4d.js`, or
+    requested with a version query string, like `packed.js?1a2b3c4d` when
+    webassets' `url_expire` is on, never change, so they are served with
+    `Cache-Control: public, max-age=<immutable_max_age>, immutable` and
+    browsers do not revalidate them. Other files are served with a
+    `max_age` seconds TTL. By default, a fingerprint is a hex hash of at least
+    8 digits with at least one letter, following a `.` or `-` and followed by
+    the extension, so numbered or dated names like `photo-20140101.jpg` are
+    not mistaken for one. Paths using another naming convention can set the
+    `fingerprint` option to a regular expression searched in the path.
+
+    Files no larger than `max_file_size` bytes are kept in an in-memory LRU
+    cache of at most `cache_size` bytes, which is checked against the files'
+    modification times. Range requests, directory indexes and larger files are
+    served by the wrapped CherryPy tool.
+
+    The `blueberrypy serve` command installs this tool as
+    `tools.static_asset_dir` and `tools.static_asset_file`, next to CherryPy's
+    own tools, so a static path opts in by switching tools in your `app.yml`::
+
+        cherrypy.tools.static_asset_dir = StaticAssetTool(static.staticdir)
+        cherrypy.tools.static_asset_file = StaticAssetTool(static.staticfile)
+
+        app_config = {
+            "/js": {
+                "tools.static_asset_dir.on": True,
+                "tools.static_asset_dir.dir": "js",
+                "tools.static_asset_dir.max_age": 600
+            }
+        }
+    """
+
+    fingerprint = re.compile(r"[.-](?=[0-9]*[a-f])[0-9a-f]{8,}\.[^./\\]+$")
+
+    version_query_string = re.compile(r"^(v=)?(?=[0-9]*[a-f])[0-9a-f]{8,}$")
+
+    def __init__(self, callable=static.staticdir, name=None, cache_size=32 * 1024 * 1024,
+                 max_file_size=1024 * 1024):
+        HandlerTool.__init__(self, callable, name=name)
+        self.cache = _FileCache(cache_size, max_file_size)
+
+    def _wrapper(self, max_age=60, immutable_max_age=31536000, cache=True, fingerprint=None,
+                 **kwargs):
+        req = cherrypy.serving.request
+        resp = cherrypy.serving.response
+
+        if self.is_versioned(fingerprint):
+            resp.headers["Cache-Control"] = ("public, max-age=%d, immutable" %
+                                             immutable_max_age)
+        else:
+            resp.headers["Cache-Control"] = "public, max-age=%d" % max_age
+
+        handled = False
+        if cache and req.method in ("GET", "HEAD") and "Range" not in req.headers:
+            path = self._path(**kwargs)
+            if path is not None:
+                handled = self._serve_cached(path, kwargs.get("content_types"))
+
+        if not handled:
+            handled = self.callable(**kwargs)
+
+        if handled:
+            req.handler = None
+        else:
+            resp.headers.pop("Cache-Control", None)
+
+    def is_versioned(self, fingerprint=None):
+        """Returns True if the current request is for a version of a file that
+        never changes. `fingerprint` is a regular expression overriding the
+        default fingerprint convention.
+        """
+        req = cherrypy.serving.request
+        if self.version_query_string.match(req.query_string):
+            return True
+        fingerprint = re.compile(fingerprint) if fingerprint else self.fingerprint
+        return bool(fingerprint.search(req.path_info))
+
+    def _path(self, section=None, dir=None, filename=None, root=None, match="", **kwargs):
+        req = cherrypy.serving.request
+        if match and not re.search(match, req.path_info):
+            return None
+        if dir is not None:
+            return _staticdir_path(section or "/", dir, root)
+        path = _staticfile_path(filename, root)
+        if path and os.path.isabs(path):
+            return path
+
+    def _serve_cached(self, path, content_types=None):
+        try:
+            st = os.stat(path)
+        except (OSError, TypeError, ValueError):
+            return False
+
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.cache.max_file_size:
+            return False
+
+        resp = cherrypy.serving.response
+        resp.headers["Last-Modified"] = httputil.HTTPDate(st.st_mtime)
+        cptools.validate_since()
+
+        ext = os.path.splitext(path)[1].lower()
+        content_type = None
+        if content_types:
+            content_type = content_types.get(ext[1:])
+        if content_type is None:
+            content_type = mimetypes.types_map.get(ext)
+        if content_type is not None:
+            resp.headers["Content-Type"] = content_type
+
+        resp.body = self.cache.get(path, st)
+        return True
+
+
+def _handler_name(handler):
+    """Returns the dotted name of the callable of the page handler `handler`."""
+    func = getattr(handler, "callable", handler)
+    if hasattr(func, "__name__"):
+        owner = getattr(func, "__self__", None)
+        if owner is not None:
+            return "%s.%s.%s" % (owner.__class__.__module__, owner.__class__.__name__,
+                                 func.__name__)
+        return "%s.%s" % (func.__module__, func.__name__)
+    # callable objects, such as the NotFound handler
+    return "%s.%s" % (func.__class__.__module__, func.__class__.__name__)
+
+
+DEFAULT_MEMORY_PROFILE_REPORT = os.path.join(tempfile.gettempdir(),
+                                             "blueberrypy-memprofile.json")
+
+
+class MemoryProfileTool(MultiHookPointTool):
+    """A CherryPy tool that profiles the memory allocated by requests.
+
+    For a fraction `on_start_resource.sample_rate` of the requests, a
+    `tracemalloc` snapshot is taken when the request starts and when it ends,
+    and the `top` allocation sites which grew the most between the two are
+    aggregated per route. A route is the request method and the page handler,
+    such as `GET myapp.controllers.Users.show`, unless a name is given with
+    `on_start_resource.route`. `on_start_resource.frames` is the number of
+    frames of traceback `tracemalloc` keeps if it has to start tracing, and
+    sites are identified by their innermost frame. After each sampled request,
+    the aggregated report is written to `on_end_request.report_file` as JSON,
+    which can be inspected with the `blueberrypy memprofile` command.
+
+    Since `tracemalloc` traces the whole process, allocations made by
+    concurrent requests are attributed to every sampled request in flight,
+    and tracing slows down every request while a sampled request is in
+    flight. Tracing started by this tool is stopped again once no sampled
+    request is left, so the cost stays bounded by the sample rate. Keep the
+    sample rate low in production. This tool does nothing if `tracemalloc` is
+    not available.
+
+    Example::
+
+        app_config = {
+            "/": {
+                "tools.memory_profile.on": True,
+                "tools.memory_profile.on_start_resource.sample_rate": 0.001,
+                "tools.memory_profile.on_end_request.report_file": "/var/tmp/memprofile.json"
+            }
+        }
+    """
+
+    def __init__(self, top=10, name=None, priority=10):
+        MultiHookPointTool.__init__(self, name=name, priority=priority)
+        self.top = top
+        self.routes = {}
+        self._lock = threading.Lock()
+        # the number of sampled requests in flight, and whether this tool has
+        # started tracing for them
+        self._sampling = 0
+        self._tracing = False
+
+    def on_start_resource(self, sample_rate=0.01, frames=1, route=None):
+        if not tracemalloc_support or random.random() >= sample_rate:
+            return
+
+        req = cherrypy.request
+        with self._lock:
+            if not self._sampling and not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                self._tracing = True
+            self._sampling += 1
+
+        try:
+            req.memory_snapshot = self._snapshot()
+        except Exception:
+            self._stop_sampling()
+            raise
+        req.memory_route = "%s %s" % (req.method, route or _handler_name(req.handler))
+
+    def on_end_request(self, report_file=DEFAULT_MEMORY_PROFILE_REPORT):
+        req = cherrypy.request
+        start = getattr(req, "memory_snapshot", None)
+        if start is None:
+            return
+        req.memory_snapshot = None
+
+        try:
+            stats = self._snapshot().compare_to(start, "lineno")
+        finally:
+            self._stop_sampling()
+
+        with self._lock:
+            profile = self.routes.setdefault(req.memory_route, {"requests": 0, "sites": {}})
+            profile["requests"] += 1
+            for diff in stats[:self.top]:
+                if diff.size_diff <= 0:
+                    break
+                frame = diff.traceback[0]
+                site = "%s:%d" % (frame.filename, frame.lineno)
+                size_diff, count_diff = profile["sites"].get(site, (0, 0))
+                profile["sites"][site] = (size_diff + diff.size_diff,
+                                          count_diff + diff.count_diff)
+            report = self.report()
+
+        if report_file:
+            self._write_report(report, report_file)
+
+    def report(self):
+        """Returns the aggregated allocation sites of every route, sorted by the
+        total size they allocated.
+        """
+        report = {}
+        for route, profile in self.routes.viewitems():
+            sites = [{"site": site, "size_diff": size_diff, "count_diff": count_diff}
+                     for site, (size_diff, count_diff) in profile["sites"].viewitems()]
+            sites.sort(key=lambda site: site["size_diff"], reverse=True)
+            report[route] = {"requests": profile["requests"], "sites": sites}
+        return report
+
+    def _stop_sampling(self):
+        with self._lock:
+            self._sampling -= 1
+            if not self._sampling and self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>")))
+
+    def _write_report(self, report, report_file):
+        tmp_file = "%s.%d.%d.tmp" % (report_file, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(report, f, sort_keys=True)
+            os.rename(tmp_file, report_file)
+        except (IOError, OSError):
+            logger.warning("Unable to write the memory profile report to %r.", report_file,
+                           exc_info=True)
+
+
+def register_tools(redis=False, toolbox=None):
+    """Registers the tools of this module on `toolbox`, `cherrypy.tools` by
+    default, under the names below. `blueberrypy serve` and
+    `blueberrypy.testing.ControllerTestCase` call this when they start.
+
+    ================= =========================================================
+    name              tool
+    ================= =========================================================
+    request_timing    `RequestTimingTool`
+    response_cache    `ResponseCacheTool`, storing in Redis if `redis` is true
+    compress          `CompressionTool`
+    rate_limit        `RateLimitTool`, synced to Redis if `redis` is true
+    single_flight     `SingleFlightTool`, coalescing across processes through
+                      Redis if `redis` is true
+    stream_json       `stream_json`
+    static_asset_dir  `StaticAssetTool` wrapping CherryPy's `staticdir`
+    static_asset_file `StaticAssetTool` wrapping CherryPy's `staticfile`
+    memory_profile    `MemoryProfileTool`
+    ================= =========================================================
+
+    None of them replaces a CherryPy tool, and names which are already taken
+    are left alone, so a tool can be replaced by registering it beforehand.
+    A tool only runs on the paths which turn it on.
+    """
+    if toolbox is None:
+        toolbox = cherrypy.tools
+
+    tools = [("request_timing", RequestTimingTool),
+             ("response_cache",
+              lambda: ResponseCacheTool(RedisResponseStorage() if redis else None)),
+             ("compress", CompressionTool),
+             ("rate_limit", lambda: RateLimitTool(redis=redis)),
+             ("single_flight", lambda: SingleFlightTool(redis=redis)),
+             ("stream_json", lambda: Tool("before_handler", stream_json, priority=30)),
+             ("static_asset_dir", lambda: StaticAssetTool(static.staticdir)),
+             ("static_asset_file", lambda: StaticAssetTool(static.staticfile)),
+             ("memory_profile", MemoryProfileTool)]
+
+    for name, factory in tools:
+        if not hasattr(toolbox, name):
+            setattr(toolbox, name, factory())
@@ -1,9 +1,13 @@
-import copy
 import hashlib
 import hmac
 import logging
 import sys
 import textwrap
+import threading
+import types
+
+from itertools import islice
+from operator import attrgetter
 
 from base64 import b64encode, urlsafe_b64encode
 
@@ -17,12 +21,28 @@ from datetime import date, time, datetime, timedelta
 from dateutil.parser import parse as parse_date
 
 try:
-    from sqlalchemy.orm import RelationshipProperty, Session, collections
+    from sqlalchemy import and_, event, inspect, or_
+    from sqlalchemy.engine import RowProxy
+    from sqlalchemy.orm import Mapper, Query, RelationshipProperty, Session, collections
+    from sqlalchemy.orm.exc import UnmappedColumnError
+    from sqlalchemy.orm.interfaces import MANYTOONE
 except ImportError:
     sqlalchemy_support = False
 else:
     sqlalchemy_support = True
 
+    try:
+        from sqlalchemy.orm import selectinload as batchload
+    except ImportError:
+        # SQLAlchemy < 1.2
+        from sqlalchemy.orm import subqueryload as batchload
+
+    try:
+        from sqlalchemy.util._collections import AbstractKeyedTuple as KeyedTuple
+    except ImportError:
+        # SQLAlchemy < 1.0
+        from sqlalchemy.util import KeyedTuple
+
 try:
     from geoalchemy2.elements import WKTElement, WKBElement
     from geoalchemy2.shape import from_shape, to_shape
@@ -33,8 +53,8 @@ else:
     geos_support = True
 
 
-__all__ = ["from_collection", "to_collection", "CSRFToken",
-           "pad_block_cipher_message", "unpad_block_cipher_message"]
+__all__ = ["from_collection", "to_collection", "to_columns", "iter_json", "register_converter",
+           "CSRFToken", "pad_block_cipher_message", "unpad_block_cipher_message"]
 
 
 logger = logging.getLogger(__name__)
@@ -58,24 +78,382 @@ def _get_model_properties(model, excludes, recursive=False):
     return props
 
 
-def _ensure_is_dict(key, inc_exc):
+class _SerializationPlan(object):
+    """The attributes `to_collection()` serializes for a model class given some
+    includes, excludes and recursiveness, the loadable relationships among
+    them, and the backref properties to exclude from the related models.
+    """
+
+    __slots__ = ("attrs", "getters", "relationships", "backref_excludes", "extract")
+
+    def __init__(self, attrs, relationships, backref_excludes):
+        self.attrs = attrs
+        self.getters = tuple([attrgetter(attr) for attr in attrs])
+        self.relationships = relationships
+        self.backref_excludes = backref_excludes
+
+        # a single getter for the values of all the attributes as a tuple
+        if len(attrs) > 1:
+            self.extract = attrgetter(*attrs)
+        elif attrs:
+            self.extract = lambda model, getter=self.getters[0]: (getter(model),)
+        else:
+            self.extract = lambda model: ()
+
+
+# relationships with these loader strategies are not loaded to be converted
+_UNTRAVERSED_LOADERS = ("dynamic", "noload", "raise", "raise_on_sql")
+
+_plan_cache = {}
+_plan_cache_lock = threading.Lock()
+_max_plans = 1024
+
+
+def _clear_plan_cache():
+    with _plan_cache_lock:
+        _plan_cache.clear()
+
+
+if sqlalchemy_support:
+    # mapping more classes or properties invalidates the plans
+    event.listen(Mapper, "after_configured", _clear_plan_cache)
+
+
+def _get_serialization_plan(model, spec, recursive=False):
+    cls = model.__class__
+    includes = spec.includes
+    excludes = spec.excludes
+    key = (cls, includes.get(cls, _EMPTY), excludes.get(cls, _EMPTY), bool(recursive))
+
+    plan = _plan_cache.get(key)
+    if plan is None:
+        backref_excludes = {}
+        props = _get_model_properties(model, backref_excludes, recursive=recursive)
+
+        attrs = set(props.viewkeys())
+        attrs |= includes.get(cls, _EMPTY)
+        attrs -= excludes.get(cls, _EMPTY)
+        attrs -= backref_excludes.get(cls, _EMPTY)
+        attrs = tuple(sorted([attr for attr in attrs if not attr.startswith("_")]))
+        relationships = tuple([attr for attr in attrs
+                               if isinstance(props.get(attr), RelationshipProperty)
+                               if props[attr].lazy not in _UNTRAVERSED_LOADERS])
+
+        backref_excludes = tuple([(related_cls, frozenset(keys))
+                                  for related_cls, keys in backref_excludes.viewitems()])
+        plan = _SerializationPlan(attrs, relationships, backref_excludes)
 
-    if inc_exc:
-        inc_exc = copy.deepcopy(inc_exc)
+        with _plan_cache_lock:
+            if len(_plan_cache) >= _max_plans:
+                _plan_cache.clear()
+            _plan_cache[key] = plan
 
-        if isinstance(inc_exc, basestring):
-            inc_exc = {key: set([inc_exc])}
-        elif isinstance(inc_exc, (list, tuple, set, frozenset)):
-            inc_exc = {key: set(iter(inc_exc))}
-        elif not isinstance(inc_exc, dict):
-            raise TypeError(inc_exc, "Please provide a string, an iterable or a dict")
+    return plan
 
-        return inc_exc
 
-    return {}
+_EMPTY = frozenset()
+
+
+def _normalize_inc_exc(inc_exc):
+    """Returns `inc_exc` as a mapping of classes to frozensets of property keys,
+    or as a frozenset if it is not keyed by class.
+    """
+
+    if not inc_exc:
+        return {}
+
+    if isinstance(inc_exc, basestring):
+        return frozenset([inc_exc])
+    elif isinstance(inc_exc, (list, tuple, set, frozenset)):
+        return frozenset(inc_exc)
+    elif isinstance(inc_exc, dict):
+        return dict([(cls, frozenset([keys]) if isinstance(keys, basestring) else frozenset(keys))
+                     for cls, keys in inc_exc.viewitems()])
+
+    raise TypeError(inc_exc, "Please provide a string, an iterable or a dict")
+
+
+def _freeze_inc_exc(inc_exc):
+    if isinstance(inc_exc, dict):
+        return frozenset(inc_exc.viewitems())
+    return inc_exc
+
+
+class _Spec(object):
+    """An immutable, normalized pair of includes and excludes.
+
+    Includes and excludes not keyed by class apply to the class of the first
+    model object found, and are bound to it with `bind()`. Specs derived from
+    this one are cached, so a spec is only built once per top-level call no
+    matter how many objects are processed. Specs with the same includes and
+    excludes are equal, however they were derived.
+    """
+
+    __slots__ = ("includes", "excludes", "_derived", "_hash")
+
+    def __init__(self, includes=None, excludes=None):
+        self.includes = _normalize_inc_exc(includes)
+        self.excludes = _normalize_inc_exc(excludes)
+        self._derived = {}
+        self._hash = None
+
+    @classmethod
+    def _make(cls, includes, excludes):
+        spec = cls.__new__(cls)
+        spec.includes = includes
+        spec.excludes = excludes
+        spec._derived = {}
+        spec._hash = None
+        return spec
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not _Spec or hash(self) != hash(other):
+            return False
+        return self.includes == other.includes and self.excludes == other.excludes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((_freeze_inc_exc(self.includes), _freeze_inc_exc(self.excludes)))
+        return self._hash
+
+    def bind(self, cls):
+        """Returns this spec with the includes and excludes not keyed by class
+        keyed by `cls`.
+        """
+        if isinstance(self.includes, dict) and isinstance(self.excludes, dict):
+            return self
+
+        spec = self._derived.get(cls)
+        if spec is None:
+            includes = self.includes if isinstance(self.includes, dict) else {cls: self.includes}
+            excludes = self.excludes if isinstance(self.excludes, dict) else {cls: self.excludes}
+            spec = self._derived[cls] = self._make(includes, excludes)
+        return spec
+
+    def excluding(self, additions):
+        """Returns this spec with the additional excludes `additions`, a tuple
+        of class and frozenset of property keys pairs.
+        """
+        if not additions:
+            return self
+
+        spec = self._derived.get(additions)
+        if spec is None:
+            if all([keys <= self.excludes.get(cls, _EMPTY) for cls, keys in additions]):
+                self._derived[additions] = self
+                return self
+            excludes = dict(self.excludes)
+            for cls, keys in additions:
+                excludes[cls] = excludes.get(cls, _EMPTY) | keys
+            spec = self._derived[additions] = self._make(self.includes, excludes)
+        return spec
+
+
+class _Walk(object):
+    """The model objects a recursive `to_collection()` is converting a value
+    for, and the limits of the conversion.
+
+    A walk is passed down in place of `recursive`, as it is true, and each
+    model object converted passes a walk with itself added to its values.
+    """
+
+    __slots__ = ("ancestors", "depth", "limits")
 
+    def __init__(self, ancestors, depth, limits):
+        self.ancestors = ancestors
+        self.depth = depth
+        self.limits = limits
 
-def to_collection(from_, includes=None, excludes=None, format=None, recursive=False, **json_kwargs):
+    @classmethod
+    def start(cls, max_depth=None, max_nodes=None, references=False):
+        return cls(frozenset(), 0, _WalkLimits(max_depth, max_nodes, references))
+
+    def enter(self, model, spec):
+        """Returns the walk for the values of `model` converted with `spec`, or
+        None if `model` is to be converted to a reference.
+        """
+        # the same object converted with the same spec again down the same
+        # path would be forever
+        key = (id(model), spec)
+        if key in self.ancestors:
+            return None
+        limits = self.limits
+        if limits.max_depth is not None and self.depth > limits.max_depth:
+            return None
+        if limits.emitted is not None and id(model) in limits.emitted:
+            return None
+
+        limits.nodes += 1
+        if limits.max_nodes is not None and limits.nodes > limits.max_nodes:
+            raise ValueError("to_collection() converted more than %d model objects."
+                             % limits.max_nodes)
+        if limits.emitted is not None:
+            # keeps the object alive so its id is not reused
+            limits.emitted[id(model)] = model
+
+        return _Walk(self.ancestors | frozenset([key]), self.depth + 1, limits)
+
+
+class _WalkLimits(object):
+
+    __slots__ = ("max_depth", "max_nodes", "nodes", "emitted")
+
+    def __init__(self, max_depth, max_nodes, references):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.emitted = {} if references else None
+
+
+def _reference(model, spec):
+    mapper = model.__mapper__
+    ident = mapper.primary_key_from_instance(model)
+    return {"$ref": dict([(mapper.get_property_by_column(col).key,
+                           _to_collection(value, spec, False))
+                          for col, value in zip(mapper.primary_key, ident)])}
+
+
+# the most primary keys in one IN clause when preloading relationships
+_preload_chunk_size = 500
+
+# the fewest lazy loads of a relationship at a level to load in a batch instead
+_batch_load_threshold = 3
+
+
+def _preload_relationships(from_, spec, limits):
+    """Loads the relationships a recursive `to_collection()` is about to read
+    in batches instead of with one lazy load per object.
+
+    The object graph is walked level by level with the same serialization
+    plans as `to_collection()`. When the objects of a class at a level would
+    lazy load a relationship with `_batch_load_threshold` queries or more, they
+    are queried again by primary key with the relationship loaded eagerly.
+    Relationships deeper than the `max_depth` of the walk `limits` are not
+    loaded, and loading stops once the walk would reach more than its
+    `max_nodes` model objects, as converting them raises `ValueError` anyway.
+    """
+
+    max_depth = limits.max_depth
+    max_nodes = limits.max_nodes
+    if max_nodes is not None:
+        max_nodes -= limits.nodes
+    references = limits.emitted is not None
+
+    level = [(obj, spec) for obj in from_ if hasattr(obj, "__mapper__")]
+    seen = set()
+    depth = 0
+    while level and (max_depth is None or depth <= max_depth):
+        depth += 1
+        groups = {}
+        for obj, spec in level:
+            # with references an object is converted only once, whatever the
+            # spec it is reached with
+            key = id(obj) if references else (id(obj), spec)
+            if key not in seen:
+                seen.add(key)
+                if max_nodes is not None and len(seen) > max_nodes:
+                    return
+                spec = spec.bind(obj.__class__)
+                groups.setdefault((obj.__class__, spec), []).append(obj)
+
+        level = []
+        for (cls, spec), objs in groups.viewitems():
+            plan = _get_serialization_plan(objs[0], spec, recursive=True)
+            if not plan.relationships:
+                continue
+
+            _batch_load(cls, objs, plan.relationships)
+
+            spec = spec.excluding(plan.backref_excludes)
+            for obj in objs:
+                for attr in plan.relationships:
+                    value = getattr(obj, attr)
+                    if value is None:
+                        continue
+                    elif hasattr(value, "__mapper__"):
+                        level.append((value, spec))
+                    else:
+                        values = value.viewvalues() if isinstance(value, dict) else value
+                        level.extend([(v, spec) for v in values])
+
+
+def _lazy_load(state, prop):
+    """Returns the identity of what lazy loading the relationship `prop` of
+    `state` queries, or None if it does not query the database.
+    """
+
+    if prop.direction is not MANYTOONE:
+        return state.key
+
+    # many-to-one relationships to the primary key get the related object from
+    # the session if it is there already
+    remote_to_local = dict([(remote, local) for local, remote in prop.local_remote_pairs])
+    ident = []
+    for col in prop.mapper.primary_key:
+        if col not in remote_to_local:
+            return state.key
+        try:
+            key = state.mapper.get_property_by_column(remote_to_local[col]).key
+        except UnmappedColumnError:
+            return state.key
+        if key not in state.dict:
+            return state.key
+        ident.append(state.dict[key])
+
+    if None in ident:
+        return None
+
+    key = prop.mapper.identity_key_from_primary_key(ident)
+    return None if key in state.session.identity_map else key
+
+
+def _batch_load(cls, objs, attrs):
+    relationships = cls.__mapper__.relationships
+    unloaded = {}
+    for obj in objs:
+        state = inspect(obj)
+        if state.session_id is None or state.key is None:
+            continue
+        for attr in attrs:
+            if attr in state.unloaded:
+                load = _lazy_load(state, relationships[attr])
+                if load is not None:
+                    loads, states = unloaded.setdefault(attr, (set(), []))
+                    loads.add(load)
+                    states.append(state)
+
+    # a batch takes two queries, one for the objects again and one for their
+    # relationships, which is only worth it for more than two lazy loads
+    batches = {}
+    for attr, (loads, states) in unloaded.viewitems():
+        if len(loads) >= _batch_load_threshold:
+            for state in states:
+                batches.setdefault(state.session, {}).setdefault(state.key, set()).add(attr)
+
+    for session, identities in batches.viewitems():
+        options = [batchload(getattr(cls, attr))
+                   for attr in set().union(*identities.viewvalues())]
+        idents = [key[1] for key in identities]
+        for i in range(0, len(idents), _preload_chunk_size):
+            criterion = _identity_criterion(cls.__mapper__, idents[i:i + _preload_chunk_size])
+            session.query(cls).filter(criterion).options(*options).autoflush(False).all()
+
+
+def _identity_criterion(mapper, idents):
+    pk_cols = mapper.primary_key
+    if len(pk_cols) == 1:
+        return pk_cols[0].in_([ident[0] for ident in idents])
+    return or_(*[and_(*[col == value for col, value in zip(pk_cols, ident)])
+                 for ident in idents])
+
+
+def to_collection(from_, includes=None, excludes=None, format=None, recursive=False,
+                  max_depth=None, max_nodes=None, references=False, **json_kwargs):
     """Convert complex values and SQLAlchemy declarative model objects to a Python collections.
 
     This function generally works very similar to `json.dump()`, with the
@@ -101,7 +479,8 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
 
     Furthermore, GeoAlchemy2 `WKT/WKBElement values are also converted to
     `geojson <http://geojson.org/>`_ format using `Shapely
-    <http://toblerity.github.com/shapely/>_`.
+    <http://toblerity.github.com/shapely/>_`. Conversions for other types, such
+    as `Decimal` or `UUID`, can be added with `register_converter()`.
 
     If `includes` is provided, additional attribute(s) in the model value(s)
     will be included in the returned result. `includes` can be a string, an
@@ -114,8 +493,8 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     will be excluded from the returned result.
 
     Internally, `to_collection()` will convert the provided `includes` and
-    `excludes` property sets to a mapping of the classes of the values to lists
-    of property key strings.
+    `excludes` property sets to a mapping of the classes of the values to sets
+    of property key strings once, and share it for all the values.
 
     **Note:** Mapped property names starting with '_' will never be included in the
     returned result.
@@ -128,6 +507,36 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     `includes` or `excludes` property sets, it is encouraged that you provide
     mappings for explicitness.
 
+    A model object found again while converting its own related objects, with
+    the same includes and excludes, is not converted again, as that would
+    never end, but replaced by a reference to it, a dict of its primary key
+    property names and values under a `$ref` key::
+
+        {"$ref": {"id": 1}}
+
+    The cost of traversing a large object graph can be bounded with
+    `max_depth` and `max_nodes`. Model objects reached through more than
+    `max_depth` relationships are replaced by references, and if more than
+    `max_nodes` model objects would be converted, `ValueError` is raised. If
+    `references` is True, every model object already converted elsewhere in
+    the result is replaced by a reference too, instead of being converted
+    again.
+
+    If `recursive` is True and `from_` is a model object, a list of them or a
+    query, the relationships to traverse that are not loaded yet are loaded in
+    batches, one level of the object tree at a time, instead of with one query
+    per object.
+
+    SQLAlchemy result rows
+    ----------------------
+    If `from_` is a row of a SQLAlchemy Core result, or of a query for columns
+    such as `session.query(User.id, User.name)`, `to_collection()` will return
+    a dict of the row's keys and their values, converted the same way as the
+    values of model objects. Serializing rows instead of model objects avoids
+    loading them into the session, which makes it the cheaper choice for large
+    read-only results. Unlike the elements of other collections, the rows of a
+    list or a query are converted to dicts even if `recursive` is False.
+
     Complex values
     --------------
     If `from_` is not a a SQLAlchemy declarative model, it must be a Python
@@ -143,7 +552,10 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
 
 
     If `format` is the string `json`, the result returned will be a JSON string
-    , otherwise a Python collection object will be returned.
+    , otherwise a Python collection object will be returned. The elements of
+    collections are converted one by one while the JSON string is encoded, so
+    the whole converted collection is never held in memory, unless a `cls` or
+    a `default` function is given in `json_kwargs` or `references` is True.
 
     If any `json_kwargs` is provided, they will be passed through to the
     underlying simplejson JSONDecoder.
@@ -164,54 +576,299 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     {'name': 'Hong Kong Park', 'founded': {'date': '1991-05-23'}, 'location': {'type': 'Point', 'coordinates': [22.2771398, 114.1613993]}}]
 
     """
-    if hasattr(from_, "__mapper__"):
+    spec = _Spec(includes, excludes)
+
+    if recursive:
+        recursive = _Walk.start(max_depth, max_nodes, references)
 
-        if not sqlalchemy_support:
-            raise ImportError(textwrap.dedent("""SQLAlchemy not installed.
+    if recursive and sqlalchemy_support:
+        if isinstance(from_, Query):
+            from_ = from_.all()
+        if hasattr(from_, "__mapper__"):
+            _preload_relationships([from_], spec, recursive.limits)
+        elif isinstance(from_, (list, tuple)):
+            _preload_relationships(from_, spec, recursive.limits)
 
-            Please use install it first before proceding:
+    if format == "json":
+        return _dumps(from_, spec, recursive, json_kwargs)
 
-            $ pip install sqlalchemy
-            """))
+    return _to_collection(from_, spec, recursive)
 
-        includes = _ensure_is_dict(from_.__class__, includes)
-        excludes = _ensure_is_dict(from_.__class__, excludes)
 
-        props = _get_model_properties(from_, excludes, recursive=recursive)
-        attrs = set(props.viewkeys())
-        if includes and from_.__class__ in includes:
-            attrs |= includes[from_.__class__]
-        if excludes and from_.__class__ in excludes:
-            attrs -= excludes[from_.__class__]
+def _to_collection(from_, spec, recursive):
+    cls = type(from_)
+    if cls in _json_native_types:
+        return from_
 
-        result = {}
-        for attr in attrs:
-            if not attr.startswith("_"):
-                val = getattr(from_, attr)
-                val = to_collection(val, includes=includes, excludes=excludes, recursive=recursive)
-                result[attr] = val
+    converter = _converter_cache.get(cls)
+    if converter is None:
+        converter = _get_converter(cls)
+    return converter(from_, spec, recursive, _to_collection)
+
+
+class _Node(object):
+    """An element of a collection `_CollectionEncoder` converts with
+    `to_collection()` rules when it is encoded.
+    """
+
+    __slots__ = ("value", "spec", "recursive")
+
+    def __init__(self, value, spec, recursive):
+        self.value = value
+        self.spec = spec
+        self.recursive = recursive
+
+
+def _defer_element(from_, spec, recursive):
+    if type(from_) in _json_native_types:
+        return from_
+    return _Node(from_, spec, recursive)
+
+
+def _defer(from_, spec, recursive):
+    cls = type(from_)
+    if cls in _json_native_types:
+        return from_
+
+    converter = _converter_cache.get(cls)
+    if converter is None:
+        converter = _get_converter(cls)
+    if converter is _convert_iterable or converter is _convert_other:
+        return _Node(from_, spec, recursive)
+    return converter(from_, spec, recursive, _defer)
+
+
+class _CollectionEncoder(json.JSONEncoder):
+    """A JSON encoder converting values while it encodes them instead of
+    encoding a fully converted collection.
+
+    Collections are converted into lists of `_Node` elements, which the
+    encoder passes to `default()` one at a time to be converted, so only one
+    converted element is kept in memory at a time instead of the whole
+    converted collection.
+    """
+
+    def default(self, o):
+        if type(o) is _Node:
+            from_ = o.value
+            converter = _converter_cache.get(type(from_))
+            if converter is None:
+                converter = _get_converter(type(from_))
+            if converter is _convert_iterable or converter is _convert_other:
+                return converter(from_, o.spec, o.recursive, _defer_element)
+            return converter(from_, o.spec, o.recursive, _defer)
+        return super(_CollectionEncoder, self).default(o)
+
+
+def _dumps(from_, spec, recursive, json_kwargs):
+    if "cls" in json_kwargs or "default" in json_kwargs:
+        # custom encoders get the converted collection as before
+        return json.dumps(_to_collection(from_, spec, recursive), **json_kwargs)
+    if type(recursive) is _Walk and recursive.limits.emitted is not None:
+        # which occurrence of an object becomes a reference depends on the
+        # order objects are converted in, and the encoder converts nested
+        # collections after the other values of their model object
+        return json.dumps(_to_collection(from_, spec, recursive), **json_kwargs)
+    return json.dumps(_defer(from_, spec, recursive), cls=_CollectionEncoder, **json_kwargs)
+
+
+def _convert_model(from_, spec, recursive, visit):
+    if not sqlalchemy_support:
+        raise ImportError(textwrap.dedent("""SQLAlchemy not installed.
+
+        Please use install it first before proceding:
+
+        $ pip install sqlalchemy
+        """))
+
+    spec = spec.bind(from_.__class__)
+
+    if type(recursive) is _Walk:
+        walk = recursive.enter(from_, spec)
+        if walk is None:
+            return _reference(from_, spec)
+        recursive = walk
+
+    plan = _get_serialization_plan(from_, spec, recursive=recursive)
+    spec = spec.excluding(plan.backref_excludes)
+
+    result = {}
+    for attr, getter in zip(plan.attrs, plan.getters):
+        value = getter(from_)
+        if type(value) in _json_native_types:
+            result[attr] = value
+        else:
+            result[attr] = visit(value, spec, recursive)
+    return result
+
+
+def _convert_row(from_, spec, recursive, visit):
+    result = {}
+    for key, value in zip(from_.keys(), from_):
+        if type(value) in _json_native_types:
+            result[key] = value
+        else:
+            result[key] = visit(value, spec, recursive)
+    return result
+
+
+def _convert_dict(from_, spec, recursive, visit):
+    result = {}
+    for k, v in from_.items():
+        result[unicode(k)] = visit(v, spec, recursive)
+    return result
+
+
+def _convert_iterable(from_, spec, recursive, visit):
+    if recursive:
+        return [visit(v, spec, recursive) for v in from_]
+    # a list of rows, such as a query for columns returns, is only useful
+    # with the keys of the rows
+    return [_convert_row(v, spec, recursive, visit) if isinstance(v, _row_types) else v
+            for v in from_]
+
+
+def _convert_other(from_, spec, recursive, visit):
+    # old-style class instances may or may not be iterable
+    if iterable(from_):
+        return _convert_iterable(from_, spec, recursive, visit)
+    return from_
+
+
+def _identity(from_, spec, recursive, visit):
+    return from_
+
+
+# exact types returned as is without looking up a converter
+_json_native_types = frozenset([type(None), bool, int, long, float, str, unicode])
+
+_converters = {
+    basestring: _identity,
+    bytes: _identity,
+    bytearray: _identity,
+    bool: _identity,
+    int: _identity,
+    long: _identity,
+    float: _identity,
+    type(None): _identity,
+    datetime: lambda from_, spec, recursive, visit: {"datetime": from_.isoformat()},
+    time: lambda from_, spec, recursive, visit: {"time": from_.isoformat()},
+    date: lambda from_, spec, recursive, visit: {"date": from_.isoformat()},
+    timedelta: lambda from_, spec, recursive, visit: {"interval": from_.seconds},
+    dict: _convert_dict,
+}
+
+_row_types = ()
+
+if sqlalchemy_support:
+    _row_types = (RowProxy, KeyedTuple)
+    _converters[RowProxy] = _converters[KeyedTuple] = _convert_row
+
+if geos_support:
+    _converters[WKTElement] = _converters[WKBElement] = \
+        lambda from_, spec, recursive, visit: as_geojson(to_shape(from_))
+
+# converters resolved for the types actually seen
+_converter_cache = {}
+
+# the type of old-style class instances, which only Python 2 has
+_InstanceType = getattr(types, "InstanceType", None)
+
+
+def _get_converter(cls):
+    if hasattr(cls, "__mapper__"):
+        converter = _convert_model
     else:
-        if isinstance(from_, datetime):
-            result = {"datetime": from_.isoformat()}
-        elif isinstance(from_, time):
-            result = {"time": from_.isoformat()}
-        elif isinstance(from_, date):
-            result = {"date": from_.isoformat()}
-        elif isinstance(from_, timedelta):
-            result = {"interval": from_.seconds}
-        elif geos_support and isinstance(from_, (WKTElement, WKBElement)):
-            result = as_geojson(to_shape(from_))
-        elif isinstance(from_, dict):
-            result = {}
-            for k, v in from_.items():
-                result[unicode(k)] = to_collection(v, includes=includes, excludes=excludes,
-                                                   recursive=recursive)
-        # iterable collections, not strings
-        elif iterable(from_) and not isinstance(from_, (basestring, bytes, bytearray)):
-            result = [to_collection(v, includes=includes, excludes=excludes, recursive=recursive)
-                      for v in from_] if recursive else list(from_)
+        for base in cls.__mro__:
+            converter = _converters.get(base)
+            if converter is not None:
+                break
         else:
-            result = from_
+            if cls is _InstanceType:
+                converter = _convert_other
+            elif hasattr(cls, "__iter__") or hasattr(cls, "__getitem__"):
+                converter = _convert_iterable
+            else:
+                converter = _identity
+
+    _converter_cache[cls] = converter
+    return converter
+
+
+def register_converter(type_, converter):
+    """Register a function converting values of `type_` for `to_collection()`.
+
+    `converter` is called with each value of `type_`, or of a subclass of it,
+    that `to_collection()` finds and must return a value `json.dumps()` can
+    encode. Registering a converter for a type `to_collection()` already
+    converts, such as `date`, replaces the default conversion. Values whose
+    type is exactly `bool`, `int`, `long`, `float`, `str`, `unicode` or `None`
+    are always returned as is.
+
+    >>> from decimal import Decimal
+    >>> register_converter(Decimal, str)
+    >>> to_collection([Decimal("1.10")], recursive=True)
+    ['1.10']
+    """
+
+    _converters[type_] = lambda from_, spec, recursive, visit: converter(from_)
+    _converter_cache.clear()
+
+
+def to_columns(from_, includes=None, excludes=None, format=None, layout="rows",
+               **json_kwargs):
+    """Convert a list of SQLAlchemy declarative model objects of one class to a
+    column-oriented collection.
+
+    This is a bulk alternative to `to_collection()` for large, homogeneous
+    results such as a query for reports. Instead of a dict per object, the
+    result names the properties once and lists the values of every object in
+    the same order::
+
+        {"columns": ["id", "name"], "rows": [[1, "a"], [2, "b"]]}
+
+    If `layout` is `columns`, the result maps each property to the list of its
+    values instead::
+
+        {"id": [1, 2], "name": ["a", "b"]}
+
+    The properties and the conversion of their values are the same as those
+    of `to_collection()`, but relationships are never traversed. `from_` can be
+    any iterable, such as a SQLAlchemy query, and all its elements must be of
+    the same class, otherwise `ValueError` is raised.
+
+    `includes`, `excludes`, `format` and `json_kwargs` have the same meaning
+    as in `to_collection()`.
+    """
+
+    if layout not in ("rows", "columns"):
+        raise ValueError("layout must be 'rows' or 'columns'.")
+
+    spec = _Spec(includes, excludes)
+    attrs = ()
+    rows = []
+    cls = None
+    for model in from_:
+        if model.__class__ is not cls:
+            if cls is not None:
+                raise ValueError("to_columns() needs objects of a single class, found %r and %r."
+                                 % (cls, model.__class__))
+            if not hasattr(model, "__mapper__"):
+                raise TypeError("%r is not a SQLAlchemy declarative model object." % model)
+            cls = model.__class__
+            spec = spec.bind(cls)
+            plan = _get_serialization_plan(model, spec)
+            attrs = plan.attrs
+            extract = plan.extract
+
+        rows.append([value if type(value) in _json_native_types
+                     else _to_collection(value, spec, False)
+                     for value in extract(model)])
+
+    if layout == "columns":
+        result = dict([(attr, [row[i] for row in rows]) for i, attr in enumerate(attrs)])
+    else:
+        result = {"columns": list(attrs), "rows": rows}
 
     if format == "json":
         return json.dumps(result, **json_kwargs)
@@ -219,13 +876,113 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     return result
 
 
-def _get_property_instance(session, mapping, prop):
+def iter_json(from_, includes=None, excludes=None, recursive=False, yield_per=100,
+              max_depth=None, max_nodes=None, references=False, **json_kwargs):
+    """Iterate through the JSON array encoding of the iterable `from_` in chunks.
+
+    This function is the streaming equivalent of
+    `to_collection(from_, format="json")` for large results. The elements of
+    `from_` are fetched, converted with `to_collection()` and encoded
+    `yield_per` at a time, so the memory used does not depend on the number of
+    elements. If `from_` is a SQLAlchemy query, its rows are also fetched from
+    the database `yield_per` at a time, and with `recursive` their
+    relationships are loaded in batches for each chunk.
+
+    `includes`, `excludes`, `recursive`, `max_depth`, `max_nodes`,
+    `references` and `json_kwargs` have the same meaning as in
+    `to_collection()`, and the limits apply to the whole result.
+
+    >>> "".join(iter_json(range(3)))
+    '[0, 1, 2]'
+    """
+
+    if hasattr(from_, "yield_per"):
+        from_ = from_.yield_per(yield_per)
+
+    spec = _Spec(includes, excludes)
+    if recursive:
+        recursive = _Walk.start(max_depth, max_nodes, references)
+
+    from_ = iter(from_)
+    sep = "["
+    while True:
+        values = list(islice(from_, yield_per))
+        if recursive and sqlalchemy_support:
+            _preload_relationships(values, spec, recursive.limits)
+
+        chunk = []
+        for value in values:
+            chunk.append(sep + _dumps(value, spec, recursive, json_kwargs))
+            sep = ", "
+        if len(values) < yield_per:
+            break
+        yield "".join(chunk)
+
+    chunk.append("[]" if sep == "[" else "]")
+    yield "".join(chunk)
+
+
+def _mapping_identity(mapping, mapper):
+    return tuple([mapping[pk_col.key] for pk_col in mapper.primary_key if pk_col.key in mapping])
+
+
+def _collect_identities(from_, cls, spec, identities):
+    """Collects the primary keys of the related objects `from_collection()`
+    will look up while applying the mapping `from_` to an object of `cls`,
+    keyed by mapper.
+    """
+
+    backref_excludes = {}
+    props = _get_model_properties(cls, backref_excludes, recursive=True)
+    attrs = set(props.viewkeys())
+    attrs -= spec.excludes.get(cls, _EMPTY)
+    attrs -= backref_excludes.get(cls, _EMPTY)
+    spec = spec.excluding(tuple([(related_cls, frozenset(keys))
+                                 for related_cls, keys in backref_excludes.viewitems()]))
+
+    for attr in attrs:
+        prop = props[attr]
+        if attr in from_ and isinstance(prop, RelationshipProperty):
+            from_val = from_[attr]
+            if isinstance(from_val, list):
+                mappings = from_val
+            elif isinstance(from_val, dict) and (prop.uselist is None or prop.uselist):
+                mappings = from_val.viewvalues()
+            else:
+                mappings = [from_val]
+
+            for mapping in mappings:
+                if isinstance(mapping, dict):
+                    ident = _mapping_identity(mapping, prop.mapper)
+                    if len(ident) == len(prop.mapper.primary_key):
+                        identities.setdefault(prop.mapper, set()).add(ident)
+                    _collect_identities(mapping, prop.mapper.class_, spec, identities)
+
+
+def _fetch_instances(session, identities):
+    """Loads the objects with the primary keys in `identities`, a mapping of
+    mappers to sets of primary keys, with one query per mapper, and returns
+    them keyed by mapper and primary key.
+    """
+
+    instances = {}
+    for mapper, idents in identities.viewitems():
+        idents = [ident for ident in idents
+                  if mapper.identity_key_from_primary_key(ident) not in session.identity_map]
+        for i in range(0, len(idents), _preload_chunk_size):
+            criterion = _identity_criterion(mapper, idents[i:i + _preload_chunk_size])
+            for inst in session.query(mapper.class_).filter(criterion):
+                instances[(mapper, inspect(inst).identity)] = inst
+    return instances
+
+
+def _get_property_instance(session, mapping, prop, instances=None):
     prop_cls = prop.mapper.class_
-    prop_pk_vals = tuple((mapping[pk_col.key]
-                          for pk_col in prop.mapper.primary_key
-                          if pk_col.key in mapping))
+    prop_pk_vals = _mapping_identity(mapping, prop.mapper)
     if prop_pk_vals:
-        prop_inst = session.query(prop_cls).get(prop_pk_vals)
+        prop_inst = instances.get((prop.mapper, prop_pk_vals)) if instances else None
+        if prop_inst is None:
+            prop_inst = session.query(prop_cls).get(prop_pk_vals)
     elif prop.mapper.polymorphic_on is not None:
         prop_inst = prop.mapper.polymorphic_map[mapping[prop.mapper.get_property_by_column(
             prop.mapper.polymorphic_on).key]].class_()
@@ -258,7 +1015,17 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
     supplied relationship mappings will be converted to the correct subclass
     instances and replace the entire relationship collection on the parent
     objects. If the value is `append`, the mapped model instance will be
-    appended to the relationship collection instead.
+    appended to the relationship collection instead. If the value is `merge`,
+    the mappings are matched with the objects already in the relationship
+    collection by primary key. The matching objects are updated in place, new
+    ones are appended and the objects not matched are removed, so unchanged
+    objects stay in the collection untouched. Nested relationship collections
+    are merged too, while they are replaced with the other two values.
+
+    Relationship mappings with primary key values are applied to the existing
+    objects with those primary keys. Before anything is applied, the mappings
+    are scanned and the objects not in the session yet are loaded with one
+    query per class, instead of one query per mapping.
 
     If a key from the mapping is not found as a column on a model instance, it
     will simply be skipped and not set on the instance.
@@ -285,16 +1052,80 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
     if format == "json":
         from_ = json.loads(from_)
 
-    if collection_handling not in ["replace", "append"]:
-        raise ValueError("collection_handling must be 'replace' or 'append'.")
+    if collection_handling not in ["replace", "append", "merge"]:
+        raise ValueError("collection_handling must be 'replace', 'append' or 'merge'.")
+
+    spec = _Spec(excludes=excludes).bind(to_.__class__)
 
-    excludes = _ensure_is_dict(to_.__class__, excludes)
+    instances = None
+    if sqlalchemy_support:
+        if isinstance(from_, dict) and hasattr(to_, "__mapper__"):
+            pairs = [(from_, to_)]
+        elif isinstance(from_, list) and isinstance(to_, list):
+            pairs = [(f, t) for f, t in zip(from_, to_)
+                     if isinstance(f, dict) and hasattr(t, "__mapper__")]
+        else:
+            pairs = []
+
+        identities = {}
+        sessions = set()
+        for f, t in pairs:
+            session = Session.object_session(t)
+            if session is not None:
+                sessions.add(session)
+                _collect_identities(f, t.__class__, spec, identities)
+        if len(sessions) == 1 and identities:
+            instances = _fetch_instances(sessions.pop(), identities)
+
+    return _from_collection(from_, to_, spec, collection_handling, instances)
+
+
+def _merge_collection(to_, attr, prop, from_iterator, spec, instances):
+    """Applies the mappings from `from_iterator` to the members of the
+    relationship collection `attr` of `to_` with the same primary keys, and
+    only adds and removes the members that differ.
+    """
+
+    col = getattr(to_, attr)
+    adapter = collections.collection_adapter(col)
+    members = list(adapter)
+
+    existing = {}
+    for member in members:
+        ident = tuple(prop.mapper.primary_key_from_instance(member))
+        if None not in ident:
+            existing[ident] = member
+
+    results = []
+    for v in from_iterator:
+        ident = _mapping_identity(v, prop.mapper)
+        prop_inst = existing.get(ident) if len(ident) == len(prop.mapper.primary_key) else None
+        if prop_inst is None:
+            prop_inst = _get_property_instance(Session.object_session(to_), v, prop, instances)
+        results.append(_from_collection(v, prop_inst, spec, "merge", instances))
+
+    kept = set([id(result) for result in results])
+    for member in members:
+        if id(member) not in kept:
+            adapter.remove_with_event(member)
+
+    present = set([id(member) for member in members])
+    for result in results:
+        if id(result) not in present:
+            adapter.append_with_event(result)
+            present.add(id(result))
+
+
+def _from_collection(from_, to_, spec, collection_handling, instances=None):
+    # nested collections are replaced, unless they are merged
+    nested_handling = "merge" if collection_handling == "merge" else "replace"
 
     if isinstance(from_, dict):
         if isinstance(to_, dict):
             for k in to_.viewkeys():
                 if k in from_:
-                    to_[k] = from_collection(from_[k], to_[k], excludes=excludes)
+                    to_[k] = _from_collection(from_[k], to_[k], spec, nested_handling,
+                                              instances)
         elif hasattr(to_, "__mapper__"):
 
             if not sqlalchemy_support:
@@ -305,10 +1136,13 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
                 $ pip install sqlalchemy
                 """))
 
-            props = _get_model_properties(to_, excludes, recursive=True)
+            backref_excludes = {}
+            props = _get_model_properties(to_, backref_excludes, recursive=True)
             attrs = set(props.viewkeys())
-            if excludes and to_.__class__ in excludes:
-                attrs -= excludes[to_.__class__]
+            attrs -= spec.excludes.get(to_.__class__, _EMPTY)
+            attrs -= backref_excludes.get(to_.__class__, _EMPTY)
+            spec = spec.excluding(tuple([(cls, frozenset(keys))
+                                         for cls, keys in backref_excludes.viewitems()]))
 
             for attr in attrs:
                 if attr in from_:
@@ -320,6 +1154,15 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
 
                         if prop.uselist is None or prop.uselist:
 
+                            from_iterator = (iter(from_val)
+                                             if isinstance(from_val, list)
+                                             else from_val.viewvalues())
+
+                            if collection_handling == "merge":
+                                _merge_collection(to_, attr, prop, from_iterator, spec,
+                                                  instances)
+                                continue
+
                             if collection_handling == "replace":
                                 col = collections.prepare_instrumentation(prop.collection_class or
                                                                           list)()
@@ -328,24 +1171,32 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
 
                             appender = col._sa_appender
 
-                            from_iterator = (iter(from_val)
-                                             if isinstance(from_val, list)
-                                             else from_val.viewvalues())
-
                             for v in from_iterator:
                                 prop_inst = _get_property_instance(Session.object_session(to_), v,
-                                                                   prop)
-                                appender(from_collection(v, prop_inst, excludes=excludes))
+                                                                   prop, instances)
+                                appender(_from_collection(v, prop_inst, spec, "replace",
+                                                          instances))
 
                             if collection_handling == "replace":
                                 setattr(to_, attr, col)
                         else:
-                            prop_inst = _get_property_instance(Session.object_session(to_),
-                                                               from_val, prop)
-                            setattr(to_, attr, from_collection(from_val, prop_inst,
-                                                               excludes=excludes))
+                            prop_inst = None
+                            if collection_handling == "merge":
+                                # update the related object in place if it is the same one
+                                current = getattr(to_, attr)
+                                ident = _mapping_identity(from_val, prop.mapper)
+                                if current is not None:
+                                    current_ident = prop.mapper.primary_key_from_instance(current)
+                                    if tuple(current_ident) == ident:
+                                        prop_inst = current
+                            if prop_inst is None:
+                                prop_inst = _get_property_instance(Session.object_session(to_),
+                                                                   from_val, prop, instances)
+                            setattr(to_, attr, _from_collection(from_val, prop_inst, spec,
+                                                                nested_handling, instances))
                     else:
-                        setattr(to_, attr, from_collection(from_val, None, excludes=excludes))
+                        setattr(to_, attr, _from_collection(from_val, None, spec,
+                                                            nested_handling, instances))
         else:
             if "date" in from_:
                 to_ = parse_date(from_["date"]).date()
@@ -366,7 +1217,8 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
         elif len(from_) != len(to_):
             raise ValueError("length of to_ must match length of from_.")
 
-        to_ = [from_collection(f, t, excludes=excludes) for f, t in zip(from_, to_)]
+        to_ = [_from_collection(f, t, spec, nested_handling, instances)
+               for f, t in zip(from_, to_)]
 
     else:
         to_ = from_